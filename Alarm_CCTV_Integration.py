@@ -6,9 +6,9 @@ from io import BytesIO
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseUpload
-from datetime import datetime as dt
 import RPi.GPIO as GPIO
 import time
+from Alarm_Core import AlarmEvent, parse_alarm_table
 
 # Path to your service account key file
 SERVICE_ACCOUNT_FILE = "/home/roozdar/Desktop/projects/uplifted-record-443616-e6-63005fbd7104.json"  # Update with your Raspberry Pi file path
@@ -19,6 +19,7 @@ ALARM_LOG_SHEET_NAME = "Alarm Log"
 CREDENTIALS_SHEET_NAME = "Credentials"
 CREDENTIALS_RANGE = f"{CREDENTIALS_SHEET_NAME}!B1:B2"  # Range for JWT token and base URL
 ALARM_TABLE_RANGE = f"{CREDENTIALS_SHEET_NAME}!A5:G"  # Full range of the alarm table
+ALARM_TABLE_COLUMNS = 7  # Contact ID, Site, Location, Floor, Zone, Alarm Station, Camera ID
 
 # Serial configuration
 SERIAL_PORT = '/dev/ttyUSB0'
@@ -60,7 +61,7 @@ def load_alarm_table():
         range=ALARM_TABLE_RANGE
     ).execute()
     rows = result.get('values', [])
-    alarm_table = {row[0]: row[1:] for row in rows if len(row) >= 7}  # Map Contact ID to remaining values
+    alarm_table = parse_alarm_table(rows, ALARM_TABLE_COLUMNS)  # Map Contact ID to its AlarmStation
     return alarm_table
 
 def fetch_and_resize_image(base_url, jwt_token, device_id):
@@ -113,23 +114,18 @@ def get_next_available_row():
     next_row = len(rows) + 1
     return next_row
 
-def append_row_to_sheet(data, image_buffer, image_height, device_id):
+def append_row_to_sheet(station, event, image_buffer, image_height):
     sheets = authenticate_sheets()
     next_row = get_next_available_row()
     image_url = upload_image_to_drive(image_buffer, "alarm_snapshot.jpg")
-    video_url = f"https://webapp.eagleeyenetworks.com/#/videoext/{device_id}"
+    video_url = f"https://webapp.eagleeyenetworks.com/#/videoext/{station.camera_id}"
     requests_body = [
         {
             "updateCells": {
                 "rows": [
                     {
                         "values": [
-                            {"userEnteredValue": {"stringValue": str(data[0])}},
-                            {"userEnteredValue": {"stringValue": str(data[1])}},
-                            {"userEnteredValue": {"stringValue": str(data[2])}},
-                            {"userEnteredValue": {"stringValue": str(data[3])}},
-                            {"userEnteredValue": {"stringValue": str(data[4])}},
-                            {"userEnteredValue": {"stringValue": str(data[5])}},
+                            *({"userEnteredValue": {"stringValue": value}} for value in station.row_values(event)),
                             {
                                 "userEnteredValue": {
                                     "formulaValue": f'=HYPERLINK("{video_url}", IMAGE("{image_url}"))'
@@ -159,16 +155,15 @@ def append_row_to_sheet(data, image_buffer, image_height, device_id):
         spreadsheetId=SPREADSHEET_ID, body={"requests": requests_body}
     ).execute()
 
-def handle_trigger(contact_id, alarm_table, jwt_token, base_url):
-    row_data = alarm_table.get(contact_id)
-    if not row_data:
+def handle_trigger(event, alarm_table, jwt_token, base_url):
+    contact_id = event.contact_id
+    station = alarm_table.get(contact_id)
+    if not station:
         print(f"No config for ID {contact_id}")
         return
-    device_id = row_data[-1]
-    row_to_log = row_data[:-1] + [dt.now().strftime("%Y-%m-%d %H:%M:%S")]
     try:
-        img_buf, img_h = fetch_and_resize_image(base_url, jwt_token, device_id)
-        append_row_to_sheet(row_to_log, img_buf, img_h, device_id)
+        img_buf, img_h = fetch_and_resize_image(base_url, jwt_token, station.camera_id)
+        append_row_to_sheet(station, event, img_buf, img_h)
         print(f"Logged snapshot for Contact ID {contact_id}")
     except Exception as e:
         print(f"Error handling trigger for Contact ID {contact_id}: {e}")
@@ -182,7 +177,7 @@ def gpio_monitor(alarm_table, jwt_token, base_url):
                 if state == GPIO.LOW and not handled[contact_id]:
                     handled[contact_id] = True
                     print(f"Hardware alarm on Contact ID {contact_id}")
-                    handle_trigger(contact_id, alarm_table, jwt_token, base_url)
+                    handle_trigger(AlarmEvent(contact_id, "gpio", payload={"pin": pin}), alarm_table, jwt_token, base_url)
                 elif state == GPIO.HIGH and handled[contact_id]:
                     handled[contact_id] = False
             time.sleep(0.1)
@@ -211,7 +206,7 @@ def serial_monitor(alarm_table, jwt_token, base_url):
                 payload, flag = parts
                 if flag == '1':
                     print("Software alarm ON received (serial)")
-                    handle_trigger("1", alarm_table, jwt_token, base_url)
+                    handle_trigger(AlarmEvent("1", "serial", payload={"frame": payload}), alarm_table, jwt_token, base_url)
             except Exception as e:
                 print(f"Serial parse error: {e} | Raw: {line!r}")
     except Exception as e:
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import logging
+import re
+import time
+from dataclasses import dataclass, field
+
+log = logging.getLogger("alarm")
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Priority classes for the optional Priority column of the alarm table, most urgent first
+PRIORITY_CLASSES = ("critical", "high", "normal", "low")
+DEFAULT_PRIORITY = "normal"
+
+
+# ——— Alarm model ————————————————————————————————————————————————————
+@dataclass(slots=True, frozen=True)
+class AlarmStation:
+    """One row of the alarm table: Contact ID, the descriptive columns, Camera ID(s)[, Priority].
+
+    labels holds the descriptive columns in sheet order, e.g. (Site, Location,
+    Floor, Zone, Table, Alarm Unit) for the 8-column table or (Site, Location,
+    Floor, Zone, Alarm Station) for the 7-column one. The Camera ID cell may list
+    several cameras separated by commas, semicolons or spaces.
+    """
+    contact_id: str
+    labels: tuple
+    camera_ids: tuple
+    priority: str = DEFAULT_PRIORITY
+
+    @property
+    def camera_id(self):
+        """The primary (first listed) camera."""
+        return self.camera_ids[0]
+
+    @property
+    def rank(self):
+        """0 for the most urgent class; lower ranks are always dispatched first."""
+        return PRIORITY_CLASSES.index(self.priority)
+
+    def row_values(self, event):
+        """Values logged to the Alarm Log for event, before the snapshot cell."""
+        return [*self.labels, event.timestamp()]
+
+
+@dataclass(slots=True)
+class AlarmEvent:
+    """An alarm raised by a source ("gpio", "serial", "s850", ...)."""
+    contact_id: str
+    source: str
+    monotonic: float = field(default_factory=time.monotonic)
+    wall_time: float = field(default_factory=time.time)
+    payload: dict = None
+
+    def timestamp(self):
+        return time.strftime(TIMESTAMP_FORMAT, time.localtime(self.wall_time))
+
+    def age(self):
+        return time.monotonic() - self.monotonic
+
+    def to_dict(self):
+        """Wire form for another host; monotonic clocks don't travel, so the age does."""
+        return {"contact_id": self.contact_id, "source": self.source, "wall_time": self.wall_time,
+                "age": self.age(), "payload": self.payload}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["contact_id"], data["source"], time.monotonic() - data.get("age", 0.0),
+                   data["wall_time"], data.get("payload"))
+
+
+# ——— Alarm table ————————————————————————————————————————————————————
+def parse_alarm_table(rows, columns, first_row=5, max_cameras=None):
+    """Validate the alarm table rows read from the Credentials sheet, once, at load.
+
+    Rows that are short or lack a Contact ID or Camera ID are skipped with a
+    warning; for a duplicated Contact ID the last row wins, as before. A cell
+    after the Camera ID, if present, is the station's priority class. With
+    max_cameras, a station listing more cameras keeps the first max_cameras.
+    """
+    table = {}
+    for row_number, row in enumerate(rows, start=first_row):
+        cells = [str(cell).strip() for cell in row]
+        if not any(cells):
+            continue
+        if len(cells) < columns:
+            log.warning("Alarm table row %d has %d of %d columns; skipped", row_number, len(cells), columns)
+            continue
+        contact_id, *labels, cameras = cells[:columns]
+        camera_ids = tuple(c for c in re.split(r"[,;\s]+", cameras) if c)
+        if not contact_id or not camera_ids:
+            log.warning("Alarm table row %d is missing its Contact ID or Camera ID; skipped", row_number)
+            continue
+        if max_cameras and len(camera_ids) > max_cameras:
+            log.warning("Alarm table row %d lists %d cameras; only the first %d are used",
+                        row_number, len(camera_ids), max_cameras)
+            camera_ids = camera_ids[:max_cameras]
+        priority = cells[columns].lower() if len(cells) > columns and cells[columns] else DEFAULT_PRIORITY
+        if priority not in PRIORITY_CLASSES:
+            log.warning("Alarm table row %d has unknown priority %r; using %s", row_number, priority, DEFAULT_PRIORITY)
+            priority = DEFAULT_PRIORITY
+        if contact_id in table:
+            log.warning("Alarm table row %d repeats Contact ID %s; it replaces the earlier row", row_number, contact_id)
+        table[contact_id] = AlarmStation(contact_id, tuple(labels), camera_ids, priority)
+    return table
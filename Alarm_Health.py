@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger("health")
+
+# ——— Configuration ——————————————————————————————————————————————————
+# Loopback only: /health and /metrics are unauthenticated and name every source and its last
+# error. Exposing them to the LAN (e.g. for a Prometheus scraper) is opt-in via --health-host.
+HEALTH_HOST = "127.0.0.1"
+HEALTH_PORT = 8088
+RESTART_BACKOFF_S = 1.0       # first restart delay, doubled on every consecutive failure
+RESTART_BACKOFF_MAX_S = 60.0
+HEALTHY_RUN_S = 60.0          # a thread that ran this long resets its backoff
+
+
+# ——— Registry ————————————————————————————————————————————————————————
+class SourceHealth:
+    __slots__ = ("name", "state", "stale_after", "last_activity", "last_activity_wall",
+                 "started", "restarts", "errors", "last_error", "alarms", "thread")
+
+    def __init__(self, name, stale_after=None):
+        self.name = name
+        self.state = "starting"
+        self.stale_after = stale_after
+        self.last_activity = None       # monotonic, for ages
+        self.last_activity_wall = None  # epoch, for humans
+        self.started = None
+        self.restarts = 0
+        self.errors = 0
+        self.last_error = None
+        self.alarms = 0
+        self.thread = None
+
+    def alive(self):
+        return self.thread is not None and self.thread.is_alive() and self.state == "running"
+
+    def stale(self, now):
+        if self.stale_after is None:
+            return False
+        last = self.last_activity if self.last_activity is not None else self.started
+        return last is None or now - last > self.stale_after
+
+    def as_dict(self, now):
+        return {
+            "state": self.state,
+            "alive": self.alive(),
+            "stale": self.stale(now),
+            "last_activity_age_s": round(now - self.last_activity, 3) if self.last_activity is not None else None,
+            "last_activity": self.last_activity_wall,
+            "uptime_s": round(now - self.started, 3) if self.started is not None else None,
+            "restarts": self.restarts,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "alarms": self.alarms,
+        }
+
+
+class HealthRegistry:
+    """Per-source liveness and counters. activity() is cheap enough for pigpio callbacks."""
+
+    def __init__(self):
+        self.sources = {}
+        self.gauges = {}
+        self.counters = {}
+
+    def source(self, name, stale_after=None):
+        src = self.sources.get(name)
+        if src is None:
+            src = self.sources[name] = SourceHealth(name, stale_after)
+        elif stale_after is not None:
+            src.stale_after = stale_after
+        return src
+
+    def activity(self, name):
+        src = self.sources.get(name) or self.source(name)
+        src.last_activity = time.monotonic()
+        src.last_activity_wall = time.time()
+
+    def alarm(self, name):
+        self.source(name).alarms += 1
+
+    def error(self, name, exc):
+        src = self.source(name)
+        src.errors += 1
+        src.last_error = f"{type(exc).__name__}: {exc}"
+
+    def gauge(self, name, fn):
+        """Register a callable sampled on every /health or /metrics request (e.g. a queue depth)."""
+        self.gauges[name] = fn
+
+    def counter(self, name, fn):
+        """Register a monotonically increasing value exposed as name_total in /metrics."""
+        self.counters[name] = fn
+
+    def _sample(self, fns):
+        values = {}
+        for name, fn in fns.items():
+            try:
+                values[name] = fn()
+            except Exception as e:
+                values[name] = None
+                log.debug("Sampling %s failed: %s", name, e)
+        return values
+
+    def snapshot(self):
+        now = time.monotonic()
+        sources = {name: src.as_dict(now) for name, src in self.sources.items()}
+        supervised = [s for s in self.sources.values() if s.thread is not None]
+        healthy = all(s.alive() and not s.stale(now) for s in supervised)
+        return {
+            "healthy": healthy,
+            "time": time.time(),
+            "sources": sources,
+            "gauges": self._sample(self.gauges),
+            "counters": self._sample(self.counters),
+        }
+
+
+health = HealthRegistry()
+
+
+# ——— Supervision ————————————————————————————————————————————————————
+def supervise(name, target, *args, stale_after=None, registry=health):
+    """Run target(*args) in a daemon thread, restarting it with backoff whenever it exits.
+
+    Monitor loops are meant to run forever, so a return counts as a failure too.
+    """
+    src = registry.source(name, stale_after)
+
+    def runner():
+        backoff = RESTART_BACKOFF_S
+        while True:
+            src.state = "running"
+            src.started = time.monotonic()
+            try:
+                target(*args)
+                log.warning("Monitor %s exited", name, extra={"fields": {"source": name}})
+            except Exception as e:
+                registry.error(name, e)
+                log.exception("Monitor %s crashed: %s", name, e, extra={"fields": {"source": name}})
+            if time.monotonic() - src.started >= HEALTHY_RUN_S:
+                backoff = RESTART_BACKOFF_S
+            src.state = "backoff"
+            src.restarts += 1
+            log.info("Restarting %s in %.0f s", name, backoff, extra={"fields": {"source": name, "backoff_s": backoff}})
+            time.sleep(backoff)
+            backoff = min(backoff * 2, RESTART_BACKOFF_MAX_S)
+
+    src.thread = threading.Thread(target=runner, name=name, daemon=True)
+    src.thread.start()
+    return src.thread
+
+
+# ——— HTTP endpoint ——————————————————————————————————————————————————
+def _prometheus(snapshot):
+    lines = []
+    fields = [("up", lambda s: int(s["alive"])),
+              ("stale", lambda s: int(s["stale"])),
+              ("last_activity_age_seconds", lambda s: s["last_activity_age_s"]),
+              ("restarts_total", lambda s: s["restarts"]),
+              ("errors_total", lambda s: s["errors"]),
+              ("alarms_total", lambda s: s["alarms"])]
+    for metric, get in fields:
+        lines.append(f"# TYPE alarm_source_{metric} {'counter' if metric.endswith('_total') else 'gauge'}")
+        for name, src in snapshot["sources"].items():
+            value = get(src)
+            if value is not None:
+                lines.append(f'alarm_source_{metric}{{source="{name}"}} {value}')
+    for kind, key in (("gauge", "gauges"), ("counter", "counters")):
+        for name, value in snapshot[key].items():
+            if value is None:
+                continue
+            metric = f"alarm_{name}_total" if kind == "counter" else f"alarm_{name}"
+            lines.append(f"# TYPE {metric} {kind}")
+            lines.append(f"{metric} {value}")
+    lines.append(f"alarm_healthy {int(snapshot['healthy'])}")
+    return "\n".join(lines) + "\n"
+
+
+class _HealthHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        snapshot = self.server.registry.snapshot()
+        if self.path in ("/", "/health"):
+            body = json.dumps(snapshot, indent=2).encode()
+            self._reply(200 if snapshot["healthy"] else 503, "application/json", body)
+        elif self.path == "/metrics":
+            self._reply(200, "text/plain; version=0.0.4", _prometheus(snapshot).encode())
+        else:
+            self._reply(404, "text/plain", b"not found\n")
+
+    def _reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        log.debug("HTTP %s " + fmt, self.address_string(), *args)
+
+
+def start_health_server(host=HEALTH_HOST, port=HEALTH_PORT, registry=health):
+    server = ThreadingHTTPServer((host, port), _HealthHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name="health-http", daemon=True).start()
+    log.info("Health endpoint on http://%s:%d/health", host, server.server_address[1])
+    return server
@@ -1,36 +1,84 @@
 #!/usr/bin/env python3
+import argparse
+import functools
+import json
+import os
+import socket
 import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 import serial
 import requests
 from PIL import Image
 from io import BytesIO
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseUpload
-from datetime import datetime
-import RPi.GPIO as GPIO
+import httplib2
 import pigpio
 import time
+import logging
+from Alarm_Logging import setup_logging, queue_depth, dropped_records
+from Alarm_Health import HEALTH_HOST, health, supervise, start_health_server
+from Alarm_Core import AlarmEvent, AlarmStation, parse_alarm_table
+from GPIO_Bank import GpioBank
+from Alarm_Relay import BATCH_MAX, CentralDispatcher, EdgeForwarder, parse_address, RELAY_PORT
+from Alarm_Partitions import PartitionedAlarmLog
+from Alarm_Profiler import RateCounter, install_signal_toggle, profiler
+from Alarm_Scheduler import AlarmScheduler
+from Alarm_Sinks import FileSink, LateSnapshot, LoggedAlarm, SinkFanout, SnapshotStore
+
+log = logging.getLogger("alarm")
 
 # ——— Configuration ——————————————————————————————————————————————————
 SERVICE_ACCOUNT_FILE = "/home/roozdar/Desktop/projects/uplifted-record-443616-e6-63005fbd7104.json"
 SPREADSHEET_ID = "1JLkeTBw8zTdtnHyQ5vTcsVsgxsdKuNBJoyjHQ3v-ThA"
 ALARM_LOG_SHEET_NAME = "Alarm Log"
+ALARM_LOG_PARTITION = "month"  # "month", "week", "rows" (every ALARM_LOG_PARTITION_ROWS) or None for one sheet
+ALARM_LOG_PARTITION_ROWS = 5000
+ALARM_LOG_HEADER = ["Site", "Location", "Floor", "Zone", "Table", "Alarm Unit", "Timestamp", "Snapshot", "Late Snapshots"]
 CREDENTIALS_SHEET_NAME = "Credentials"
 CREDENTIALS_RANGE = f"{CREDENTIALS_SHEET_NAME}!B1:B2"
-ALARM_TABLE_RANGE = f"{CREDENTIALS_SHEET_NAME}!A5:H"  # 8 columns: Contact ID, Site, Location, Floor, Zone, Table, Alarm Unit, Camera ID
+# 8 columns: Contact ID, Site, Location, Floor, Zone, Table, Alarm Unit, Camera ID, then an optional
+# Priority column (critical, high, normal or low; blank means normal)
+ALARM_TABLE_RANGE = f"{CREDENTIALS_SHEET_NAME}!A5:I"
+ALARM_TABLE_COLUMNS = 8
+# The Camera ID cell may list several cameras; their snapshots are fetched together and tiled
+# into one contact sheet. Cameras that miss the deadline are filled in from LATE_SNAPSHOT_COLUMN
+# (column I) rightwards once they arrive.
+SNAPSHOT_WIDTH = 600
+SNAPSHOT_DEADLINE_S = 5.0
+SNAPSHOT_TIMEOUT_S = 30.0  # per camera request; a camera slower than this is given up on
+SNAPSHOT_WORKERS = 6
+CONTACT_SHEET_COLUMNS = 2
+LATE_SNAPSHOT_COLUMN = 8
+MAX_CAMERAS_PER_STATION = 4  # extra cameras in a Camera ID cell are ignored; sizes the Alarm Log's grid
+# The central fetches a whole relayed batch at once: BATCH_MAX alarms times the most cameras any
+# station has, so none waits for a free worker past the deadline, but never more threads than this
+CENTRAL_SNAPSHOT_WORKERS_MAX = 64
+# Local sinks written alongside the Alarm Log, each on its own thread: "jsonl" and/or "csv"
+# (ALARM_FILE_LOG plus the extension) and "snapshots" (SNAPSHOT_STORE_DIR, keyed by the sha256
+# the file log records). They are opt-in (--sinks); the snapshot store is capped at
+# SNAPSHOT_STORE_MAX_MB, oldest files pruned first, so it can't fill the SD card.
+ALARM_SINKS = ()
+ALARM_FILE_LOG = "/home/roozdar/Desktop/projects/alarm-log/alarms"
+SNAPSHOT_STORE_DIR = "/home/roozdar/Desktop/projects/alarm-log/snapshots"
+SNAPSHOT_STORE_MAX_MB = 2048
+# Relayed alarms the Alarm Log rejects for good (not a 429, 5xx or network error) land here and are acked
+DEAD_LETTER_FILE = "/home/roozdar/Desktop/projects/alarm-log/dead-letter.jsonl"
+# Shared by the central and every edge node; an edge that can't prove it holds it is dropped.
+# Create it once with e.g. `head -c 32 /dev/urandom > relay-secret` and copy it to each Pi.
+RELAY_SECRET_FILE = "/home/roozdar/Desktop/projects/alarm-log/relay-secret"
 SERIAL_PORT = '/dev/ttyUSB0'
 BAUD_RATE = 115200
 
 # GPIO configuration for hardware triggers
-GPIO.setmode(GPIO.BCM)
 HW_BUTTONS = {
     "1": 27,  # Example mapping, update as needed
     "2": 22,
     "5": 24
 }
-for pin in HW_BUTTONS.values():
-    GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+GPIO_STALE_S = 5  # gpio_monitor scans every 0.1 s; no scan for this long means it is stuck
 
 # S850 configuration
 S850_CONTACT_ID = "6"
@@ -73,35 +121,95 @@ def load_alarm_table():
         range=ALARM_TABLE_RANGE
     ).execute()
     rows = result.get('values', [])
-    # Map Contact ID to all columns (Site, Location, Floor, Zone, Table, Alarm Unit, Camera ID)
-    alarm_table = {row[0]: row[1:] for row in rows if len(row) >= 8}
-    return alarm_table
+    # Map Contact ID to AlarmStation(labels=(Site, Location, Floor, Zone, Table, Alarm Unit), camera_ids)
+    return parse_alarm_table(rows, ALARM_TABLE_COLUMNS, max_cameras=MAX_CAMERAS_PER_STATION)
 
-def fetch_and_resize_image(base_url, jwt_token, device_id):
+def fetch_image(base_url, jwt_token, device_id):
     url = f"https://{base_url}/api/v3.0/media/liveImage.jpeg?deviceId={device_id}&type=preview"
     headers = {
         "accept": "image/jpeg",
         "authorization": f"Bearer {jwt_token}"
     }
-    response = requests.get(url, headers=headers)
+    response = requests.get(url, headers=headers, timeout=SNAPSHOT_TIMEOUT_S)
     if response.status_code != 200:
         raise Exception(f"Failed to fetch image. Status code: {response.status_code}")
-    image = Image.open(BytesIO(response.content))
-    target_width = 600
+    return Image.open(BytesIO(response.content))
+
+def resize_to_width(image, target_width=SNAPSHOT_WIDTH):
     width_percent = (target_width / float(image.size[0]))
     target_height = int((float(image.size[1]) * float(width_percent)))
-    image = image.resize((target_width, target_height), Image.ANTIALIAS)
+    # LANCZOS is the filter ANTIALIAS aliased; the alias is gone in Pillow 10
+    return image.resize((target_width, target_height), Image.LANCZOS)
+
+def encode_jpeg(image):
     buffer = BytesIO()
-    image.save(buffer, format="JPEG")
+    image.convert("RGB").save(buffer, format="JPEG")
     buffer.seek(0)
-    return buffer, target_height
+    return buffer, image.size[1]
+
+def fetch_and_resize_image(base_url, jwt_token, device_id):
+    return encode_jpeg(resize_to_width(fetch_image(base_url, jwt_token, device_id)))
+
+# ——— Multi-camera snapshots ————————————————————————————————————————————
+# Shared by every handler, so a burst of alarms never has more than SNAPSHOT_WORKERS camera fetches open
+snapshot_pool = ThreadPoolExecutor(max_workers=SNAPSHOT_WORKERS, thread_name_prefix="snapshot")
+
+def _fetch_resized(base_url, jwt_token, device_id, width):
+    return resize_to_width(fetch_image(base_url, jwt_token, device_id), width)
+
+def start_snapshots(base_url, jwt_token, camera_ids, pool=None):
+    """Start fetching and resizing all of a station's cameras; returns {camera_id: Future} in camera order.
+
+    With several cameras each one is resized to a contact-sheet tile.
+    """
+    width = SNAPSHOT_WIDTH if len(camera_ids) == 1 else SNAPSHOT_WIDTH // CONTACT_SHEET_COLUMNS
+    pool = pool or snapshot_pool
+    return {cid: pool.submit(_fetch_resized, base_url, jwt_token, cid, width) for cid in camera_ids}
 
-def upload_image_to_drive(image_buffer, file_name):
+def split_snapshots(futures):
+    """Split started fetches into ({camera_id: Image} arrived, {camera_id: Future} still running).
+
+    A camera that failed is logged and left out of both.
+    """
+    arrived, pending = {}, {}
+    for camera_id, future in futures.items():
+        if not future.done():
+            pending[camera_id] = future
+        elif future.exception() is None:
+            arrived[camera_id] = future.result()
+        else:
+            log.warning("Snapshot from camera %s failed: %s", camera_id, future.exception(),
+                        extra={"fields": {"camera_id": camera_id}})
+    return arrived, pending
+
+def fetch_snapshots(base_url, jwt_token, camera_ids, deadline_s=SNAPSHOT_DEADLINE_S):
+    """Fetch all of a station's cameras at once; split_snapshots() of what arrived within deadline_s."""
+    futures = start_snapshots(base_url, jwt_token, camera_ids)
+    wait(futures.values(), timeout=deadline_s)
+    return split_snapshots(futures)
+
+def make_contact_sheet(images):
+    """Tile snapshots CONTACT_SHEET_COLUMNS wide into one JPEG; returns (buffer, height)."""
+    if len(images) == 1:
+        return encode_jpeg(images[0])
+    tile_w = max(image.size[0] for image in images)
+    tile_h = max(image.size[1] for image in images)
+    columns = min(CONTACT_SHEET_COLUMNS, len(images))
+    rows = -(-len(images) // columns)
+    sheet = Image.new("RGB", (tile_w * columns, tile_h * rows))
+    for n, image in enumerate(images):
+        sheet.paste(image, ((n % columns) * tile_w, (n // columns) * tile_h))
+    return encode_jpeg(sheet)
+
+def authenticate_drive():
     credentials = Credentials.from_service_account_file(
         SERVICE_ACCOUNT_FILE,
         scopes=["https://www.googleapis.com/auth/drive"]
     )
-    drive_service = build("drive", "v3", credentials=credentials)
+    return build("drive", "v3", credentials=credentials)
+
+def upload_image_to_drive(image_buffer, file_name, drive_service=None):
+    drive_service = drive_service or authenticate_drive()
     file_metadata = {"name": file_name, "mimeType": "image/jpeg"}
     media = MediaIoBaseUpload(image_buffer, mimetype="image/jpeg")
     uploaded_file = drive_service.files().create(
@@ -117,114 +225,349 @@ def upload_image_to_drive(image_buffer, file_name):
     file_url = f"https://drive.google.com/uc?id={file_id}"
     return file_url
 
-def get_next_available_row():
-    sheets = authenticate_sheets()
-    result = sheets.spreadsheets().values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range=f"{ALARM_LOG_SHEET_NAME}!A:A"
-    ).execute()
-    rows = result.get('values', [])
-    next_row = len(rows) + 1
-    return next_row
+def new_alarm_log(single_writer=False):
+    # Wide enough for the logged row and every camera of a station arriving late
+    return PartitionedAlarmLog(SPREADSHEET_ID, ALARM_LOG_SHEET_NAME, ALARM_LOG_PARTITION,
+                               ALARM_LOG_PARTITION_ROWS, ALARM_LOG_HEADER, single_writer,
+                               columns=LATE_SNAPSHOT_COLUMN + MAX_CAMERAS_PER_STATION)
 
-def append_row_to_sheet(row_data, image_buffer, image_height, device_id):
-    sheets = authenticate_sheets()
-    next_row = get_next_available_row()
-    image_url = upload_image_to_drive(image_buffer, "alarm_snapshot.jpg")
-    video_url = f"https://webapp.eagleeyenetworks.com/#/videoext/{device_id}"
-    # row_data: [Site, Location, Floor, Zone, Table, Alarm Unit]
+# Partition sheetIds are cached for the life of the process
+alarm_log = new_alarm_log()
+
+def snapshot_formula(camera_id, image_url=None):
+    video_url = f"https://webapp.eagleeyenetworks.com/#/videoext/{camera_id}"
+    if image_url:
+        return f'=HYPERLINK("{video_url}", IMAGE("{image_url}"))'
+    # Degraded alarms are logged without a snapshot but still link to the live video
+    return f'=HYPERLINK("{video_url}", "No snapshot")'
+
+def row_height_request(sheet_id, row, height):
+    return {
+        "updateDimensionProperties": {
+            "range": {
+                "sheetId": sheet_id,
+                "dimension": "ROWS",
+                "startIndex": row - 1,
+                "endIndex": row,
+            },
+            "properties": {"pixelSize": height},
+            "fields": "pixelSize"
+        }
+    }
+
+def build_row_requests(sheet_id, next_row, station, event, image_url=None, image_height=None):
+    snapshot = snapshot_formula(station.camera_id, image_url)
+    # Site, Location, Floor, Zone, Table, Alarm Unit, Timestamp, then the snapshot
     requests_body = [
         {
             "updateCells": {
                 "rows": [
                     {
                         "values": [
-                            {"userEnteredValue": {"stringValue": str(row_data[0])}},  # Site
-                            {"userEnteredValue": {"stringValue": str(row_data[1])}},  # Location
-                            {"userEnteredValue": {"stringValue": str(row_data[2])}},  # Floor
-                            {"userEnteredValue": {"stringValue": str(row_data[3])}},  # Zone
-                            {"userEnteredValue": {"stringValue": str(row_data[4])}},  # Table
-                            {"userEnteredValue": {"stringValue": str(row_data[5])}},  # Alarm Unit
-                            {"userEnteredValue": {"stringValue": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}},  # Timestamp
-                            {
-                                "userEnteredValue": {
-                                    "formulaValue": f'=HYPERLINK("{video_url}", IMAGE("{image_url}"))'
-                                }
-                            }
+                            *({"userEnteredValue": {"stringValue": value}} for value in station.row_values(event)),
+                            {"userEnteredValue": {"formulaValue": snapshot}}
                         ]
                     }
                 ],
-                "start": {"sheetId": 0, "rowIndex": next_row - 1, "columnIndex": 0},
+                "start": {"sheetId": sheet_id, "rowIndex": next_row - 1, "columnIndex": 0},
                 "fields": "userEnteredValue"
             }
         },
-        {
-            "updateDimensionProperties": {
-                "range": {
-                    "sheetId": 0,
-                    "dimension": "ROWS",
-                    "startIndex": next_row - 1,
-                    "endIndex": next_row,
-                },
-                "properties": {"pixelSize": image_height},
-                "fields": "pixelSize"
-            }
-        },
     ]
+    if image_url:
+        requests_body.append(row_height_request(sheet_id, next_row, image_height))
+    return requests_body
+
+def append_row_to_sheet(station, event, image_buffer=None, image_height=None, sheets=None, drive_service=None):
+    sheets = sheets or authenticate_sheets()
+    sheet_id, next_row = alarm_log.allocate(sheets, event.wall_time)
+    image_url = upload_image_to_drive(image_buffer, "alarm_snapshot.jpg", drive_service) if image_buffer else None
+    requests_body = build_row_requests(sheet_id, next_row, station, event, image_url, image_height)
     sheets.spreadsheets().batchUpdate(
         spreadsheetId=SPREADSHEET_ID, body={"requests": requests_body}
     ).execute()
+    return sheet_id, next_row
+
+def fill_late_snapshot(sheet_id, row, column, camera_id, image_buffer, image_height, set_height,
+                       sheets=None, drive_service=None):
+    """Upload a snapshot that missed the deadline into its own cell of an already logged row."""
+    image_url = upload_image_to_drive(image_buffer, "alarm_snapshot.jpg", drive_service)
+    requests_body = [{
+        "updateCells": {
+            "rows": [{"values": [{"userEnteredValue": {"formulaValue": snapshot_formula(camera_id, image_url)}}]}],
+            "start": {"sheetId": sheet_id, "rowIndex": row - 1, "columnIndex": column},
+            "fields": "userEnteredValue"
+        }
+    }]
+    if set_height:
+        # Nothing arrived in time, so the row still has its default height
+        requests_body.append(row_height_request(sheet_id, row, image_height))
+    (sheets or authenticate_sheets()).spreadsheets().batchUpdate(
+        spreadsheetId=SPREADSHEET_ID, body={"requests": requests_body}
+    ).execute()
+
+# ——— Alarm sinks ———————————————————————————————————————————————————————
+def build_sinks(names=ALARM_SINKS):
+    """Local backends written alongside the Alarm Log; None when none are configured."""
+    sinks = []
+    for name in names:
+        if name in ("jsonl", "csv"):
+            sinks.append(FileSink(f"{ALARM_FILE_LOG}.{name}", name))
+        elif name == "snapshots":
+            sinks.append(SnapshotStore(SNAPSHOT_STORE_DIR, max_bytes=SNAPSHOT_STORE_MAX_MB * 2**20))
+        else:
+            raise ValueError(f"Unknown alarm sink {name!r}; expected jsonl, csv or snapshots.")
+    return SinkFanout(sinks) if sinks else None
+
+class AlarmLogWriter:
+    """Writes relayed alarms for the central dispatcher, one batchUpdate per batch.
+
+    Only the dispatcher's writer thread calls write_batch, so the Google clients are
+    built once and the next free row of each partition is counted instead of re-reading A:A.
+    Cameras that miss the deadline are filled in later, as in handle_alarm, from the
+    snapshot pool with their own clients.
+    """
+
+    def __init__(self, alarm_table, jwt_token, base_url):
+        self.alarm_table = alarm_table
+        self.jwt_token = jwt_token
+        self.base_url = base_url
+        self.sheets = authenticate_sheets()
+        self.drive = authenticate_drive()
+        self.alarm_log = new_alarm_log(single_writer=True)
+        cameras = max((len(station.camera_ids) for station in alarm_table.values()), default=1)
+        self.pool = ThreadPoolExecutor(max_workers=min(BATCH_MAX * cameras, CENTRAL_SNAPSHOT_WORKERS_MAX),
+                                       thread_name_prefix="central-snapshot")
+
+    def write_batch(self, relayed):
+        requests_body = []
+        logged = 0
+        # Most urgent first, so their snapshots are queued for fetching before the rest of the batch
+        default = AlarmStation("", (), ("",))
+        relayed = sorted(relayed, key=lambda item: self.alarm_table.get(item.event.contact_id, default).rank)
+        started = {}
+        for item in relayed:
+            station = self.alarm_table.get(item.event.contact_id)
+            if station and item.image is None and not item.snapshot:
+                started[id(item)] = start_snapshots(self.base_url, self.jwt_token, station.camera_ids, self.pool)
+        # One deadline for the whole batch, not one per alarm
+        wait([future for futures in started.values() for future in futures.values()], timeout=SNAPSHOT_DEADLINE_S)
+        stations = []
+        for item in relayed:
+            event = item.event
+            station = self.alarm_table.get(event.contact_id)
+            if not station:
+                log.warning("No config for Contact ID %s from %s", event.contact_id, item.node)
+                continue
+            stations.append((item, station))
+            if item.image is None:
+                item.image = self._prepare_image(item, station, started.get(id(item)))
+        placed = []
+        try:
+            for item, station in stations:
+                image_url, img_h, _ = item.image
+                sheet_id, row = self.alarm_log.allocate(self.sheets, item.event.wall_time)
+                requests_body += build_row_requests(sheet_id, row, station, item.event, image_url, img_h)
+                placed.append((item, station, (sheet_id, row)))
+                logged += 1
+            if not requests_body:
+                return
+            self.sheets.spreadsheets().batchUpdate(
+                spreadsheetId=SPREADSHEET_ID, body={"requests": requests_body}
+            ).execute()
+        except Exception:
+            self.alarm_log.forget_rows()  # re-read the partitions before the next batch
+            raise
+        for item, station, row in placed:
+            self._fill_late(item, station, row)
+        log.info("Logged %d relayed alarms", logged, extra={"fields": {"rows": logged}})
+
+    def _prepare_image(self, item, station, futures):
+        """Fetch (unless relayed) and upload item's snapshot once.
+
+        Returns (image_url, height, {camera_id: Future} still running), with None for
+        both without a snapshot. The result is kept on the RelayedAlarm, so a batch
+        retried after a failed batchUpdate neither fetches the cameras again nor
+        leaves duplicate Drive files.
+        """
+        event = item.event
+        image_url = img_h = None
+        pending = {}
+        try:
+            if item.snapshot:
+                img_buf, img_h = BytesIO(item.snapshot), item.snapshot_height
+            else:
+                arrived, pending = split_snapshots(futures)
+                img_buf = None
+                if arrived:
+                    img_buf, img_h = make_contact_sheet(list(arrived.values()))
+            if img_buf:
+                image_url = upload_image_to_drive(img_buf, "alarm_snapshot.jpg", self.drive)
+        except Exception as e:
+            health.error("alarm_handler", e)
+            log.error("Snapshot for Contact ID %s from %s failed: %s", event.contact_id, item.node, e)
+            image_url = img_h = None
+        if not image_url:
+            # Like handle_alarm: the row is still logged, linking to the live video
+            log.warning("Logging Contact ID %s from %s without snapshot", event.contact_id, item.node,
+                        extra={"fields": {"contact_id": event.contact_id, "node": item.node}})
+            img_h = None
+        item.snapshot = None  # uploaded (or given up on); the JPEG needn't stay queued for retries
+        return image_url, img_h, pending
+
+    def _fill_late(self, item, station, placed):
+        image_url, img_h, pending = item.image
+        if not pending:
+            return
+        # _late_snapshot only needs to know whether the row already has a snapshot setting its height
+        alarm = LoggedAlarm(station, item.event, b"" if image_url else None, img_h, tuple(pending))
+        for column, (camera_id, future) in enumerate(pending.items(), start=LATE_SNAPSHOT_COLUMN):
+            fill = functools.partial(_late_snapshot, None, alarm, placed, column, camera_id)
+            # Through the pool, so a camera that arrived during the batchUpdate isn't uploaded on the writer thread
+            future.add_done_callback(lambda future, fill=fill: self.pool.submit(fill, future))
+
+def is_transient(exc):
+    """Whether a failed Google API call is worth retrying: quota (429), server errors and network trouble."""
+    if isinstance(exc, HttpError):
+        return exc.resp.status == 429 or exc.resp.status >= 500
+    return isinstance(exc, (OSError, TimeoutError, httplib2.HttpLib2Error))
+
+def dead_letter_batch(batch, exc):
+    """Keep relayed alarms the Alarm Log permanently refused in DEAD_LETTER_FILE, one JSON line each."""
+    os.makedirs(os.path.dirname(DEAD_LETTER_FILE), exist_ok=True)
+    error = f"{type(exc).__name__}: {exc}"
+    with open(DEAD_LETTER_FILE, "a") as f:
+        for item in batch:
+            image_url, image_height, _ = item.image or (None, None, None)
+            f.write(json.dumps({"node": item.node, "event": item.event.to_dict(), "image_url": image_url,
+                                "image_height": image_height, "error": error}, default=str) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+# Always-on hot-path counters, exposed on /metrics
+SERIAL_FRAMES = RateCounter("serial_frames")
+S850_CALLBACKS = RateCounter("s850_callbacks")
+
+# ——— pigpio connection ————————————————————————————————————————————————
+# One pigpiod connection shared by the GPIO bank scan and the S850 callback
+_pi = None
+_pi_lock = threading.Lock()
+
+def get_pi():
+    global _pi
+    with _pi_lock:
+        if _pi is None or not _pi.connected:
+            _pi = pigpio.pi()
+            if not _pi.connected:
+                raise RuntimeError("pigpiod not running? Start with: sudo systemctl start pigpiod")
+        return _pi
 
 # ——— Alarm Handlers ————————————————————————————————————————————————
-def handle_alarm(contact_id, alarm_table, jwt_token, base_url):
-    row_data = alarm_table.get(contact_id)
-    if not row_data:
-        print(f"No config for Contact ID {contact_id}")
+def handle_alarm(event, alarm_table, jwt_token, base_url, sinks=None, degrade=None):
+    # degrade() is asked before each slow stage; when it says so the row is logged without a snapshot.
+    # The Alarm Log is written here, on the scheduler's workers, so priority and latency budgets
+    # cover the upload too; the local sinks only get a copy, on their own threads.
+    contact_id = event.contact_id
+    station = alarm_table.get(contact_id)
+    if not station:
+        log.warning("No config for Contact ID %s", contact_id)
         return
-    # row_data: [Site, Location, Floor, Zone, Table, Alarm Unit, Camera ID]
-    device_id = row_data[-1]
-    row_to_log = row_data[:-1]  # Exclude Camera ID
     try:
-        img_buf, img_h = fetch_and_resize_image(base_url, jwt_token, device_id)
-        append_row_to_sheet(row_to_log, img_buf, img_h, device_id)
-        print(f"Logged snapshot for Contact ID {contact_id}")
+        img_buf = img_h = None
+        arrived, pending = {}, {}
+        if degrade is None or not degrade():
+            # All cameras at once; whatever misses the deadline is filled into the row later
+            arrived, pending = fetch_snapshots(base_url, jwt_token, station.camera_ids)
+            if degrade is not None and degrade():
+                for future in pending.values():
+                    future.cancel()
+                arrived, pending = {}, {}
+            if arrived:
+                img_buf, img_h = make_contact_sheet(list(arrived.values()))
+        alarm = LoggedAlarm(station, event, img_buf.getvalue() if img_buf else None, img_h, tuple(pending))
+        if sinks is not None:
+            sinks.submit(alarm)  # first, so the local log has the alarm even when Sheets is unreachable
+        placed = None
+        try:
+            placed = append_row_to_sheet(station, event, img_buf, img_h)
+        finally:
+            for column, (camera_id, future) in enumerate(pending.items(), start=LATE_SNAPSHOT_COLUMN):
+                future.add_done_callback(functools.partial(_late_snapshot, sinks, alarm, placed, column, camera_id))
+        log.info("Logged %d of %d snapshots for Contact ID %s", len(arrived), len(station.camera_ids), contact_id,
+                 extra={"fields": {"contact_id": contact_id, "priority": station.priority,
+                                   "snapshots": len(arrived), "late": len(pending),
+                                   "latency_s": round(event.age(), 3)}})
     except Exception as e:
-        print(f"Error handling alarm for Contact ID {contact_id}: {e}")
+        health.error("alarm_handler", e)
+        log.error("Error handling alarm for Contact ID %s: %s", contact_id, e, extra={"fields": {"contact_id": contact_id}})
+
+def _late_snapshot(sinks, alarm, placed, column, camera_id, future):
+    # Done-callback on a snapshot_pool thread, so fill_late_snapshot builds its own Google clients.
+    # placed is the (sheetId, row) the alarm was logged at, or None if that write failed.
+    if future.cancelled():
+        return
+    if future.exception() is not None:
+        log.warning("Late snapshot from camera %s failed: %s", camera_id, future.exception(),
+                    extra={"fields": {"camera_id": camera_id}})
+        return
+    try:
+        img_buf, img_h = encode_jpeg(future.result())
+        if sinks is not None:
+            sinks.submit(LateSnapshot(alarm, camera_id, img_buf.getvalue(), img_h))
+        if placed is not None:
+            sheet_id, row = placed
+            fill_late_snapshot(sheet_id, row, column, camera_id, img_buf, img_h, alarm.snapshot is None)
+            log.info("Filled late snapshot from camera %s into row %d", camera_id, row,
+                     extra={"fields": {"camera_id": camera_id, "row": row}})
+    except Exception as e:
+        health.error("alarm_handler", e)
+        log.error("Late snapshot from camera %s failed: %s", camera_id, e, extra={"fields": {"camera_id": camera_id}})
 
 # Hardware GPIO monitoring (Contact IDs 1, 2, 5)
-def gpio_monitor(alarm_table, jwt_token, base_url):
-    handled = {cid: False for cid in HW_BUTTONS}
+def setup_gpio(pi):
+    for pin in HW_BUTTONS.values():
+        pi.set_mode(pin, pigpio.INPUT)
+        pi.set_pull_up_down(pin, pigpio.PUD_UP)
+
+def gpio_monitor(on_alarm):
+    # Set up here rather than at import so a supervised restart re-initialises the pins
+    pi = get_pi()
+    setup_gpio(pi)
+    # All contacts are read with one read_bank_1() call per pass and diffed as a bitmask
+    bank = GpioBank(HW_BUTTONS, pi.read_bank_1)
     try:
         while True:
-            for cid, pin in HW_BUTTONS.items():
-                state = GPIO.input(pin)
-                if state == GPIO.LOW and not handled[cid]:
-                    handled[cid] = True
-                    print(f"Hardware alarm on Contact ID {cid}")
-                    handle_alarm(cid, alarm_table, jwt_token, base_url)
-                elif state == GPIO.HIGH and handled[cid]:
-                    handled[cid] = False
+            health.activity("gpio")
+            pressed, _released = bank.scan()
+            for cid in pressed:
+                pin = HW_BUTTONS[cid]
+                log.info("Hardware alarm on Contact ID %s", cid, extra={"fields": {"contact_id": cid, "pin": pin}})
+                health.alarm("gpio")
+                on_alarm(AlarmEvent(cid, "gpio", payload={"pin": pin}))
             time.sleep(0.1)
     except Exception as e:
-        print(f"GPIO monitoring error: {e}")
-    finally:
-        GPIO.cleanup()
+        health.error("gpio", e)
+        log.exception("GPIO monitoring error: %s", e)
 
 # Serial/alarm node monitoring (Contact IDs 3, 4)
-def serial_monitor(alarm_table, jwt_token, base_url):
+def serial_monitor(on_alarm):
     try:
         ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=1)
     except serial.SerialException as e:
-        print(f"Cannot open serial port {SERIAL_PORT}: {e}")
+        health.error("serial", e)
+        log.error("Cannot open serial port %s: %s", SERIAL_PORT, e)
         return
     try:
         while True:
             line = ser.read_until(b'\r')
             if not line:
                 continue
+            health.activity("serial")
+            SERIAL_FRAMES.hit()
             try:
                 text = line.decode('ascii', errors='ignore').strip().rstrip('\r\n')
-                print(f"[Serial Debug] Raw line: {text}")
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Serial raw line: %s", text)
                 parts = text.split(',')
                 if len(parts) != 2:
                     continue
@@ -234,35 +577,37 @@ def serial_monitor(alarm_table, jwt_token, base_url):
                 if len(payload) < 4:
                     continue
                 node_id = payload[-4:].upper()
-                print(f"[Serial Debug] Extracted node_id: {node_id}")
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Serial extracted node_id: %s", node_id)
                 for cid, expected_node_id in ALARM_NODE_MAP.items():
                     if node_id == expected_node_id:
-                        print(f"Alarm node trigger for Contact ID {cid} (node_id: {node_id})")
-                        handle_alarm(cid, alarm_table, jwt_token, base_url)
+                        log.info("Alarm node trigger for Contact ID %s (node_id: %s)", cid, node_id, extra={"fields": {"contact_id": cid, "node_id": node_id}})
+                        health.alarm("serial")
+                        on_alarm(AlarmEvent(cid, "serial", payload={"node_id": node_id}))
             except Exception as e:
-                print(f"Serial parse error: {e} | Raw: {line!r}")
+                health.error("serial", e)
+                log.warning("Serial parse error: %s | Raw: %r", e, line)
     except Exception as e:
-        print(f"Serial monitoring error: {e}")
+        health.error("serial", e)
+        log.exception("Serial monitoring error: %s", e)
     finally:
         ser.close()
 
 # S850 logic (Contact ID 6)
 class S850Monitor:
-    def __init__(self, alarm_table, jwt_token, base_url):
-        self.pi = pigpio.pi()
+    def __init__(self, on_alarm, pi):
+        self.pi = pi
         self.last_fall_tick = None
         self.last_pulse_tick = None
         self.current_state = None
-        self.alarm_table = alarm_table
-        self.jwt_token = jwt_token
-        self.base_url = base_url
-        if not self.pi.connected:
-            raise RuntimeError("pigpiod not running? Start with: sudo systemctl start pigpiod")
+        self.on_alarm = on_alarm
         self.pi.set_mode(S850_STATUS_PIN, pigpio.INPUT)
         self.pi.set_pull_up_down(S850_STATUS_PIN, pigpio.PUD_UP)
-        self.pi.callback(S850_STATUS_PIN, pigpio.EITHER_EDGE, self.edge_cb)
+        self.callback = self.pi.callback(S850_STATUS_PIN, pigpio.EITHER_EDGE, self.edge_cb)
 
     def edge_cb(self, gpio, level, tick):
+        health.activity("s850")
+        S850_CALLBACKS.hit()
         if level == 0:
             self.last_fall_tick = tick
             return
@@ -277,42 +622,115 @@ class S850Monitor:
                 new_state = "ARMED"
             if new_state != self.current_state:
                 self.current_state = new_state
-                ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                print(f"[{ts}] S850 state → {self.current_state} (pulse {width} µs)")
+                log.info("S850 state → %s (pulse %d µs)", new_state, width, extra={"fields": {"state": new_state, "pulse_us": width}})
 
     def monitor(self):
         try:
             while True:
                 time.sleep(1)
                 if self.last_pulse_tick is not None and pigpio.tickDiff(self.last_pulse_tick, self.pi.get_current_tick()) > ALARM_TIMEOUT_US:
-                    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    print(f"[{ts}] *** S850 ALARM CONDITION: no pulses for >1 s ***")
-                    handle_alarm(S850_CONTACT_ID, self.alarm_table, self.jwt_token, self.base_url)
+                    log.warning("*** S850 ALARM CONDITION: no pulses for >1 s ***", extra={"fields": {"contact_id": S850_CONTACT_ID}})
+                    health.alarm("s850")
+                    self.on_alarm(AlarmEvent(S850_CONTACT_ID, "s850"))
                     self.last_pulse_tick = None
         except KeyboardInterrupt:
-            print("\n🛑 Stopping S850 monitor.")
+            log.info("Stopping S850 monitor.")
         finally:
-            self.pi.stop()
+            # The connection is shared with gpio_monitor; only drop our callback
+            self.callback.cancel()
+
+def s850_monitor(on_alarm):
+    S850Monitor(on_alarm, get_pi()).monitor()
 
 # ——— Main ————————————————————————————————————————————————————————
-def main():
+def read_relay_secret(path=RELAY_SECRET_FILE):
+    with open(path, "rb") as f:
+        secret = f.read().strip()
+    if not secret:
+        raise ValueError(f"Relay secret file {path} is empty.")
+    return secret
+
+def run_central(address, health_host=HEALTH_HOST):
+    # Central dispatcher: owns the Google clients and row allocation for every edge node
     alarm_table = load_alarm_table()
     jwt_token, base_url = read_credentials()
-    threads = []
-    threads.append(threading.Thread(target=gpio_monitor, args=(alarm_table, jwt_token, base_url), daemon=True))
-    threads.append(threading.Thread(target=serial_monitor, args=(alarm_table, jwt_token, base_url), daemon=True))
-    s850_monitor = S850Monitor(alarm_table, jwt_token, base_url)
-    threads.append(threading.Thread(target=s850_monitor.monitor, daemon=True))
-    for t in threads:
-        t.start()
-    print("Monitoring all alarm sources. Press Ctrl+C to stop.")
+    writer = AlarmLogWriter(alarm_table, jwt_token, base_url)
+    host, port = parse_address(address)
+    dispatcher = CentralDispatcher(writer.write_batch, read_relay_secret(), host, port, retryable=is_transient,
+                                   dead_letter=dead_letter_batch).start()
+    health.gauge("relay_queue_depth", dispatcher.queue_depth)
+    health.counter("relay_duplicates", lambda: dispatcher.duplicates)
+    health.counter("relay_write_failures", lambda: dispatcher.write_failures)
+    health.counter("relay_dead_lettered", lambda: dispatcher.dead_lettered)
+    health.counter("relay_rejected", lambda: dispatcher.rejected)
+    start_health_server(health_host)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        log.info("Stopping central dispatcher.")
+    finally:
+        dispatcher.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Monitor GPIO, serial alarm node and S850 alarm sources.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--edge", metavar="HOST[:PORT]",
+                      help="forward alarms to a central dispatcher instead of logging them from this Pi")
+    mode.add_argument("--central", metavar="[HOST:]PORT", nargs="?", const=str(RELAY_PORT),
+                      help="run only the central dispatcher that logs alarms relayed by edge nodes")
+    parser.add_argument("--node-id", default=socket.gethostname(), help="name this edge node reports (default: hostname)")
+    parser.add_argument("--sinks", metavar="NAME[,NAME...]",
+                        help="local copies kept besides the Alarm Log: jsonl, csv, snapshots (default: none)")
+    parser.add_argument("--health-host", default=HEALTH_HOST, metavar="HOST",
+                        help=f"interface for the health endpoint, e.g. 0.0.0.0 to expose it (default: {HEALTH_HOST})")
+    args = parser.parse_args()
+
+    setup_logging()
+    health.gauge("log_queue_depth", queue_depth)
+    health.counter("log_dropped", dropped_records)
+    for counter in (SERIAL_FRAMES, S850_CALLBACKS):
+        health.gauge(f"{counter.name}_per_second", counter.rate)
+        health.counter(counter.name, lambda counter=counter: counter.count)
+    health.gauge("profiler_running", lambda: int(profiler.running))
+    install_signal_toggle()  # kill -USR1 <pid> to start, again to stop and dump /tmp/alarm-profile-*.folded
+    if args.central:
+        run_central(args.central, args.health_host)
+        return
+    sinks = None
+    if args.edge:
+        host, port = parse_address(args.edge if ":" in args.edge else f"{args.edge}:{RELAY_PORT}")
+        forwarder = EdgeForwarder(host, port, args.node_id, read_relay_secret())
+        health.gauge("relay_pending", forwarder.pending_count)
+        health.counter("relay_dropped", lambda: forwarder.dropped)
+        on_alarm = forwarder.submit
+    else:
+        alarm_table = load_alarm_table()
+        jwt_token, base_url = read_credentials()
+        sinks = build_sinks(args.sinks.split(",") if args.sinks else ALARM_SINKS)
+        if sinks is not None:
+            sinks.register_metrics()
+        handle = functools.partial(handle_alarm, alarm_table=alarm_table, jwt_token=jwt_token, base_url=base_url,
+                                   sinks=sinks)
+        scheduler = AlarmScheduler(handle, alarm_table)
+        health.gauge("alarm_queue_depth", scheduler.queue_depth)
+        health.counter("alarms_degraded", lambda: scheduler.degraded)
+        on_alarm = scheduler.submit
+    start_health_server(args.health_host)
+    supervise("gpio", gpio_monitor, on_alarm, stale_after=GPIO_STALE_S)
+    supervise("serial", serial_monitor, on_alarm)
+    supervise("s850", s850_monitor, on_alarm)
+    log.info("Monitoring all alarm sources. Press Ctrl+C to stop.")
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        print("\nStopping all monitoring.")
+        log.info("Stopping all monitoring.")
     finally:
-        GPIO.cleanup()
+        if _pi is not None:
+            _pi.stop()
+        if sinks is not None:
+            sinks.close()  # writes out what is queued and fsyncs the file log
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+# ——— Configuration ——————————————————————————————————————————————————
+LOG_LEVEL = os.environ.get("ALARM_LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("ALARM_LOG_FORMAT", "json")  # "json" or "text"
+LOG_QUEUE_SIZE = 10_000       # records buffered before new ones are dropped
+RATE_LIMIT_WINDOW_S = 10.0    # identical rendered messages inside this window are counted, not emitted
+
+_listener = None
+_handler = None
+
+
+# ——— Formatting ——————————————————————————————————————————————————————
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line. Structured values are passed as extra={"fields": {...}}."""
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("[%(asctime)s] %(levelname)s %(name)s: %(message)s", "%Y-%m-%d %H:%M:%S")
+
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            text += f" (+{suppressed} repeats suppressed)"
+        return text
+
+
+# ——— Producer side ———————————————————————————————————————————————————
+class RateLimitFilter(logging.Filter):
+    """Suppress repeats of the same rendered message within a window.
+
+    Keyed on the formatted message, so a flood of one identical line (the same
+    serial parse error, say) collapses to one per window while alarms for
+    different contacts always get through. When a window closes with repeats,
+    a copy of the first record carrying the count is passed to emit.
+    """
+
+    def __init__(self, window_s=RATE_LIMIT_WINDOW_S, emit=None):
+        super().__init__()
+        self.window_s = window_s
+        self.emit = emit
+        self._seen = {}  # (logger, level, message) -> [window_start, suppressed, first record]
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.getMessage())
+        now = record.created
+        with self._lock:
+            slot = self._seen.get(key)
+            if slot is None or now - slot[0] >= self.window_s:
+                if slot is not None and slot[1]:
+                    self._summarise(slot)
+                self._seen[key] = [now, 0, record]
+                self._schedule(self.window_s)
+                return True
+            slot[1] += 1
+            return False
+
+    def _schedule(self, delay):
+        if self._timer is None:
+            self._timer = threading.Timer(delay, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _expire(self):
+        # Closes finished windows so their counts are reported without waiting
+        # for another matching record, and so _seen only holds open windows
+        now = time.time()
+        with self._lock:
+            self._timer = None
+            for key, slot in list(self._seen.items()):
+                if now - slot[0] >= self.window_s:
+                    del self._seen[key]
+                    if slot[1]:
+                        self._summarise(slot)
+            if self._seen:
+                oldest = min(slot[0] for slot in self._seen.values())
+                self._schedule(max(0.0, oldest + self.window_s - now))
+
+    def _summarise(self, slot):
+        if self.emit is None:
+            return
+        fields = {k: v for k, v in slot[2].__dict__.items()
+                  if k not in ("created", "msecs", "relativeCreated", "exc_info", "exc_text", "stack_info")}
+        self.emit(logging.makeLogRecord({**fields, "suppressed": slot[1]}))
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread without formatting them or ever blocking."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Records never leave the process, so there is no need to pre-render
+        # msg/args or exc_info here; all formatting happens on the listener thread.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# ——— Setup ———————————————————————————————————————————————————————————
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, stream=None):
+    """Route the root logger through a bounded queue to a background listener. Idempotent."""
+    global _listener, _handler
+    if _listener is not None:
+        logging.getLogger().setLevel(level)
+        return _listener
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    _handler = NonBlockingQueueHandler(log_queue)
+    _handler.addFilter(RateLimitFilter(emit=_handler.enqueue))
+    root = logging.getLogger()
+    root.handlers[:] = [_handler]
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def queue_depth():
+    return _handler.queue.qsize() if _handler is not None else 0
+
+
+def dropped_records():
+    return _handler.dropped if _handler is not None else 0
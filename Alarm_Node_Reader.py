@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import argparse
 import serial
 import datetime
 
@@ -35,6 +36,10 @@ def parse_message(raw_bytes):
         return f"Parse Error: {e} ? Raw: {raw_bytes!r}"
 
 def main():
+    parser = argparse.ArgumentParser(description="Print decoded Alarm Node frames.")
+    parser.add_argument("--record", metavar="PATH", help="also record raw frames to a replay capture file")
+    args = parser.parse_args()
+
     print(f"? Listening on {SERIAL_PORT} at {BAUD_RATE} baud...\n")
     try:
         ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=1)
@@ -42,11 +47,18 @@ def main():
         print(f"? Cannot open serial port {SERIAL_PORT}: {e}")
         return
 
+    capture = None
+    if args.record:
+        from Alarm_Replay import CaptureWriter
+        capture = CaptureWriter(args.record)
+
     try:
         while True:
             line = ser.read_until(b'\r')
             if not line:
                 continue
+            if capture:
+                capture.serial(line)
             entry = parse_message(line)
             if entry:
                 print(entry)
@@ -54,6 +66,8 @@ def main():
         print("\n? Logging stopped.")
     finally:
         ser.close()
+        if capture:
+            capture.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+import datetime
+import logging
+import re
+import threading
+import time
+
+log = logging.getLogger("alarm")
+
+# ——— Configuration ——————————————————————————————————————————————————
+PARTITION_MODES = (None, "month", "week", "rows")
+INDEX_SHEET_NAME = "Alarm Log Index"
+INDEX_HEADER = ["Partition", "Opens", "Created"]
+PRECREATE_AT = 0.9  # "rows" mode creates the next tab once the current one is this full
+GRID_ROWS = 1000    # rows a new month/week tab starts with; "rows" tabs get the whole partition up front
+GRID_GROW_ROWS = 1000  # rows appended when a write would land past the end of the grid
+
+
+def _quoted(title):
+    return "'" + title.replace("'", "''") + "'"
+
+
+class PartitionedAlarmLog:
+    """Routes Alarm Log rows to one tab per month, ISO week or N rows.
+
+    Tabs are named "<base> 2026-10", "<base> 2026-W42" or "<base> 0003". The next
+    tab is created ahead of time, sheetIds are cached after one spreadsheets().get,
+    and every new tab gets a header row and a linked entry in the index sheet.
+    Cell writes can't go past a tab's grid, so allocate() appends rows to it first
+    when a row would; new tabs are `columns` wide (at least the header), which
+    must cover every cell a row is ever given, late snapshots included.
+    mode=None keeps writing to the single <base> sheet.
+
+    The Sheets client is passed to each call rather than kept, because the local
+    handlers build one per alarm and clients must not be shared between threads.
+    With single_writer=True (the central dispatcher) the next free row of each tab
+    is counted locally; otherwise it is read from the tab's column A on each write,
+    which stays cheap because a tab never grows past one partition.
+    """
+
+    def __init__(self, spreadsheet_id, base_name, mode="month", rows_per_partition=5000,
+                 header=None, single_writer=False, columns=None):
+        if mode not in PARTITION_MODES:
+            raise ValueError(f"Unknown partition mode {mode!r}; expected one of {PARTITION_MODES}.")
+        self.spreadsheet_id = spreadsheet_id
+        self.base_name = base_name
+        self.mode = mode
+        self.rows_per_partition = rows_per_partition
+        self.header = list(header) if header else None
+        self.columns = max(columns or 1, len(self.header or ()))
+        self.single_writer = single_writer
+        self.sheet_ids = None   # title -> sheetId
+        self.grid_rows = {}     # title -> rows in the tab's grid
+        self.next_rows = {}     # title -> next free 1-based row (single writer only)
+        self.row_partition = 1  # current partition number in "rows" mode
+        self._lock = threading.Lock()
+
+    # ——— Public ———————————————————————————————————————————————————————
+    def allocate(self, sheets, when=None):
+        """Return (sheetId, 1-based row) for a row logged at epoch time `when`."""
+        when = time.time() if when is None else when
+        with self._lock:
+            if self.sheet_ids is None:
+                self._load(sheets)
+            if self.mode == "rows":
+                return self._allocate_by_rows(sheets, when)
+            title = self._period_title(when)
+            self._ensure(sheets, title, self._period_start(when))
+            if self.mode is not None:
+                ahead = self._period_after(when)
+                self._ensure(sheets, self._period_title(ahead), self._period_start(ahead))
+            if self.single_writer:
+                row = self._cached_next_row(sheets, title)
+                self.next_rows[title] = row + 1
+                self._ensure_grid(sheets, title, row)
+                return self.sheet_ids[title], row
+            sheet_id = self.sheet_ids[title]
+        row = self._read_next_row(sheets, title)
+        with self._lock:
+            self._ensure_grid(sheets, title, row)
+        return sheet_id, row
+
+    def forget_rows(self):
+        """Drop counted row positions, e.g. after a failed write, so they are re-read."""
+        with self._lock:
+            self.next_rows.clear()
+
+    # ——— Partition naming ————————————————————————————————————————————
+    def _period_title(self, when):
+        if self.mode is None:
+            return self.base_name
+        day = datetime.date.fromtimestamp(when)
+        if self.mode == "month":
+            return f"{self.base_name} {day:%Y-%m}"
+        year, week, _ = day.isocalendar()
+        return f"{self.base_name} {year}-W{week:02d}"
+
+    def _period_start(self, when):
+        day = datetime.date.fromtimestamp(when)
+        if self.mode == "month":
+            return day.replace(day=1).isoformat()
+        if self.mode == "week":
+            return (day - datetime.timedelta(days=day.weekday())).isoformat()
+        return datetime.datetime.fromtimestamp(when).strftime("%Y-%m-%d %H:%M:%S")
+
+    def _period_after(self, when):
+        day = datetime.date.fromtimestamp(when)
+        if self.mode == "month":
+            first_of_next = (day.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+            return time.mktime(first_of_next.timetuple())
+        return when + 7 * 86400
+
+    def _rows_title(self, number):
+        return f"{self.base_name} {number:04d}"
+
+    def _first_data_row(self):
+        return 2 if self.header else 1
+
+    def _next_row(self, sheets, title):
+        return self._cached_next_row(sheets, title) if self.single_writer else self._read_next_row(sheets, title)
+
+    def _allocate_by_rows(self, sheets, when):
+        first_data_row = self._first_data_row()
+        limit = first_data_row + self.rows_per_partition
+        while True:
+            title = self._rows_title(self.row_partition)
+            self._ensure(sheets, title, self._period_start(when))
+            row = self._next_row(sheets, title)
+            if row < limit:
+                break
+            self.row_partition += 1
+        if row - first_data_row >= self.rows_per_partition * PRECREATE_AT:
+            self._ensure(sheets, self._rows_title(self.row_partition + 1), None)
+        if self.single_writer:
+            self.next_rows[title] = row + 1
+        self._ensure_grid(sheets, title, row)
+        return self.sheet_ids[title], row
+
+    # ——— Sheets API ——————————————————————————————————————————————————
+    def _load(self, sheets):
+        meta = sheets.spreadsheets().get(
+            spreadsheetId=self.spreadsheet_id,
+            fields="sheets.properties(sheetId,title,gridProperties.rowCount)"
+        ).execute()
+        self.sheet_ids = {s["properties"]["title"]: s["properties"]["sheetId"] for s in meta.get("sheets", [])}
+        self.grid_rows = {s["properties"]["title"]: s["properties"].get("gridProperties", {}).get("rowCount", GRID_ROWS)
+                          for s in meta.get("sheets", [])}
+        if self.mode == "rows":
+            pattern = re.compile(re.escape(self.base_name) + r" (\d{4})$")
+            numbers = {int(m.group(1)) for m in map(pattern.match, self.sheet_ids) if m}
+            self.row_partition = max(numbers, default=1)
+            # The newest tab may only be the one pre-created at PRECREATE_AT; resume at the oldest with room
+            limit = self._first_data_row() + self.rows_per_partition
+            while (self.row_partition - 1 in numbers
+                   and self._next_row(sheets, self._rows_title(self.row_partition - 1)) < limit):
+                self.row_partition -= 1
+
+    def _cached_next_row(self, sheets, title):
+        if title not in self.next_rows:
+            self.next_rows[title] = self._read_next_row(sheets, title)
+        return self.next_rows[title]
+
+    def _read_next_row(self, sheets, title):
+        result = sheets.spreadsheets().values().get(
+            spreadsheetId=self.spreadsheet_id,
+            range=f"{_quoted(title)}!A:A"
+        ).execute()
+        return len(result.get("values", [])) + 1
+
+    def _add_sheet(self, sheets, title, rows=GRID_ROWS, columns=None):
+        grid = {"rowCount": rows, "columnCount": columns or self.columns}
+        reply = sheets.spreadsheets().batchUpdate(
+            spreadsheetId=self.spreadsheet_id,
+            body={"requests": [{"addSheet": {"properties": {"title": title, "gridProperties": grid}}}]}
+        ).execute()
+        sheet_id = reply["replies"][0]["addSheet"]["properties"]["sheetId"]
+        self.sheet_ids[title] = sheet_id
+        self.grid_rows[title] = rows
+        return sheet_id
+
+    def _ensure_grid(self, sheets, title, row):
+        # Another Pi may already have grown the tab; a few spare blank rows are harmless
+        if row <= self.grid_rows.get(title, GRID_ROWS):
+            return
+        length = row - self.grid_rows.get(title, GRID_ROWS) + GRID_GROW_ROWS
+        sheets.spreadsheets().batchUpdate(
+            spreadsheetId=self.spreadsheet_id,
+            body={"requests": [{"appendDimension": {"sheetId": self.sheet_ids[title], "dimension": "ROWS",
+                                                    "length": length}}]}
+        ).execute()
+        self.grid_rows[title] = self.grid_rows.get(title, GRID_ROWS) + length
+
+    def _ensure(self, sheets, title, opens):
+        if title in self.sheet_ids or self.mode is None:
+            return
+        rows = GRID_ROWS
+        if self.mode == "rows":
+            rows = max(GRID_ROWS, self.rows_per_partition + (1 if self.header else 0))
+        try:
+            sheet_id = self._add_sheet(sheets, title, rows)
+        except Exception:
+            # Another Pi may have created it first; pick up its sheetId instead
+            self._load(sheets)
+            if title in self.sheet_ids:
+                return
+            raise
+        log.info("Created Alarm Log partition %s", title, extra={"fields": {"partition": title, "sheet_id": sheet_id}})
+        if self.header:
+            self.next_rows[title] = 2
+            sheets.spreadsheets().values().update(
+                spreadsheetId=self.spreadsheet_id,
+                range=f"{_quoted(title)}!A1",
+                valueInputOption="RAW",
+                body={"values": [self.header]}
+            ).execute()
+        else:
+            self.next_rows[title] = 1
+        self._add_index_entry(sheets, title, sheet_id, opens)
+
+    def _add_index_entry(self, sheets, title, sheet_id, opens):
+        if INDEX_SHEET_NAME not in self.sheet_ids:
+            try:
+                self._add_sheet(sheets, INDEX_SHEET_NAME, columns=len(INDEX_HEADER))
+                sheets.spreadsheets().values().update(
+                    spreadsheetId=self.spreadsheet_id,
+                    range=f"{_quoted(INDEX_SHEET_NAME)}!A1",
+                    valueInputOption="RAW",
+                    body={"values": [INDEX_HEADER]}
+                ).execute()
+            except Exception:
+                self._load(sheets)
+                if INDEX_SHEET_NAME not in self.sheet_ids:
+                    raise
+        created = time.strftime("%Y-%m-%d %H:%M:%S")
+        sheets.spreadsheets().values().append(
+            spreadsheetId=self.spreadsheet_id,
+            range=f"{_quoted(INDEX_SHEET_NAME)}!A:C",
+            valueInputOption="USER_ENTERED",
+            insertDataOption="INSERT_ROWS",
+            body={"values": [[f'=HYPERLINK("#gid={sheet_id}", "{title}")', opens or "", created]]}
+        ).execute()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+log = logging.getLogger("profiler")
+
+# ——— Configuration ——————————————————————————————————————————————————
+SAMPLE_INTERVAL_S = 0.01   # 100 Hz across all threads
+PROFILE_DIR = "/tmp"
+MAX_DEPTH = 64
+
+
+# ——— Always-on counters —————————————————————————————————————————————
+class RateCounter:
+    """A counter cheap enough for pigpio callbacks: hit() is one attribute increment.
+
+    rate() is computed when read, over the time since the previous read (at least
+    one second apart), so the hot path never touches a clock.
+    """
+    __slots__ = ("name", "count", "_last_count", "_last_time", "_rate")
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self._last_count = 0
+        self._last_time = time.monotonic()
+        self._rate = 0.0
+
+    def hit(self):
+        self.count += 1
+
+    def rate(self):
+        now = time.monotonic()
+        elapsed = now - self._last_time
+        if elapsed >= 1.0:
+            count = self.count
+            self._rate = (count - self._last_count) / elapsed
+            self._last_count = count
+            self._last_time = now
+        return self._rate
+
+
+# ——— Sampling profiler ——————————————————————————————————————————————
+class SamplingProfiler:
+    """Samples every thread's Python stack and dumps collapsed stacks.
+
+    The output is one "thread;outer;...;inner count" line per distinct stack, as
+    read by flamegraph.pl and speedscope. Sampling costs one sys._current_frames()
+    walk per interval and nothing at all while stopped.
+    """
+
+    def __init__(self, interval_s=SAMPLE_INTERVAL_S):
+        self.interval_s = interval_s
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.started = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.stacks.clear()
+        self.samples = 0
+        self.started = time.time()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self._thread.start()
+        log.info("Sampling profiler started (%.0f Hz)", 1 / self.interval_s)
+
+    def stop(self, path=None):
+        """Stop sampling and write the collapsed stacks. Returns the file path."""
+        if not self.running:
+            return None
+        self._stop.set()
+        self._thread.join()
+        path = path or os.path.join(PROFILE_DIR, f"alarm-profile-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        log.info("Sampling profiler wrote %d samples to %s", self.samples, path,
+                 extra={"fields": {"samples": self.samples, "path": path, "seconds": round(time.time() - self.started, 1)}})
+        return path
+
+    def toggle(self):
+        return self.stop() if self.running else self.start()
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval_s):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                self.stacks[_collapse(names.get(ident, str(ident)), frame)] += 1
+            self.samples += 1
+
+
+def _collapse(thread_name, frame):
+    parts = []
+    while frame is not None and len(parts) < MAX_DEPTH:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    parts.append(thread_name)
+    return ";".join(reversed(parts))
+
+
+profiler = SamplingProfiler()
+
+
+def install_signal_toggle(signum=signal.SIGUSR1):
+    """`kill -USR1 <pid>` starts the profiler; the next one stops it and dumps the stacks."""
+    signal.signal(signum, lambda *_: profiler.toggle())
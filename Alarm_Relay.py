@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import queue
+import secrets
+import socket
+import socketserver
+import struct
+import threading
+import time
+import uuid
+
+from Alarm_Core import AlarmEvent
+
+log = logging.getLogger("relay")
+
+# ——— Configuration ——————————————————————————————————————————————————
+RELAY_PORT = 8765
+MAX_PENDING = 1000         # unacknowledged alarms an edge node keeps before dropping the oldest
+ACK_TIMEOUT_S = 60.0       # no ack for this long means the connection is dead; reconnect. Acks follow
+                           # the central's Sheets write, so this also covers a slow batch.
+RECONNECT_BACKOFF_S = 1.0
+RECONNECT_BACKOFF_MAX_S = 30.0
+BATCH_MAX = 20             # alarms written per Sheets batchUpdate on the central dispatcher
+BATCH_WAIT_S = 0.5         # how long the dispatcher waits to fill a batch
+WRITE_RETRY_S = 1.0        # first retry of a failed batch, doubled up to RECONNECT_BACKOFF_MAX_S
+MAX_FRAME = 8 * 1024 * 1024
+HANDSHAKE_TIMEOUT_S = 5.0  # an edge must answer the central's challenge within this
+
+# ——— Wire format ————————————————————————————————————————————————————
+# Every frame is: u32 header length, u32 blob length (big-endian), a JSON
+# header, then an optional binary blob (a JPEG snapshot).
+#   central → edge  {"type": "challenge", "nonce": "5b1e..."}
+#   edge → central  {"type": "hello", "node": "store-12", "boot": "9f2c...", "mac": "c03a..."}
+#   edge → central  {"type": "alarm", "seq": 7, "event": {...}, "snapshot_height": 450}
+#   central → edge  {"type": "ack", "seq": 7}
+# "mac" is hello_mac() of the nonce, node and boot under the shared relay secret;
+# the central drops a connection whose hello doesn't match before reading any alarm.
+# seq restarts at 1 for every boot, so the central dedupes on (node, boot, seq).
+# An ack is only sent once the alarm has been written, so an edge never lets go
+# of an alarm that a failed write or a central restart would lose.
+_FRAME_HEAD = struct.Struct(">II")
+
+
+def encode_frame(header, blob=b""):
+    head = json.dumps(header, separators=(",", ":")).encode()
+    return _FRAME_HEAD.pack(len(head), len(blob)) + head + blob
+
+
+def read_frame(stream):
+    """Read one frame from a binary file-like object. Returns (header, blob), or None at EOF."""
+    prefix = stream.read(_FRAME_HEAD.size)
+    if len(prefix) < _FRAME_HEAD.size:
+        return None
+    head_len, blob_len = _FRAME_HEAD.unpack(prefix)
+    if head_len + blob_len > MAX_FRAME:
+        raise ValueError(f"Frame of {head_len + blob_len} bytes exceeds the {MAX_FRAME} byte limit.")
+    head = stream.read(head_len)
+    blob = stream.read(blob_len)
+    if len(head) < head_len or len(blob) < blob_len:
+        return None
+    return json.loads(head), blob
+
+
+def hello_mac(secret, nonce, node, boot):
+    """HMAC-SHA256 proving an edge holds the relay secret, bound to this connection's nonce."""
+    return hmac.new(secret, f"{nonce}\n{node}\n{boot}".encode(), hashlib.sha256).hexdigest()
+
+
+# ——— Edge node ——————————————————————————————————————————————————————
+class EdgeForwarder:
+    """Streams AlarmEvents to the central dispatcher, resending anything unacknowledged after a reconnect.
+
+    submit() never blocks on the network, so it can be used directly as a monitor's on_alarm.
+    """
+
+    def __init__(self, host, port, node_id, secret, max_pending=MAX_PENDING):
+        self.address = (host, port)
+        self.node_id = node_id
+        self.secret = secret
+        self.boot = uuid.uuid4().hex[:12]
+        self.max_pending = max_pending
+        self.pending = collections.OrderedDict()  # seq -> (event, snapshot, snapshot_height)
+        self.sent_at = {}
+        self.seq = 0
+        self.dropped = 0
+        self.connected = False
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"relay-{node_id}", daemon=True)
+        self._thread.start()
+
+    def submit(self, event, snapshot=None, snapshot_height=None):
+        with self._cond:
+            self.seq += 1
+            self.pending[self.seq] = (event, snapshot, snapshot_height)
+            if len(self.pending) > self.max_pending:
+                seq, (old, _, _) = self.pending.popitem(last=False)
+                self.sent_at.pop(seq, None)
+                self.dropped += 1
+                log.warning("Relay buffer full; dropped alarm for Contact ID %s", old.contact_id,
+                            extra={"fields": {"contact_id": old.contact_id, "seq": seq}})
+            self._cond.notify()
+
+    def pending_count(self):
+        return len(self.pending)
+
+    def flush(self, timeout=None):
+        """Wait until every submitted alarm has been acknowledged. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self.pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    def _run(self):
+        backoff = RECONNECT_BACKOFF_S
+        while not self._stop.is_set():
+            try:
+                sock = socket.create_connection(self.address, timeout=5)
+            except OSError as e:
+                log.warning("Cannot reach central dispatcher %s:%d: %s", *self.address, e)
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX_S)
+                continue
+            backoff = RECONNECT_BACKOFF_S
+            try:
+                self._session(sock)
+            except (OSError, ValueError) as e:
+                log.warning("Relay connection lost: %s", e)
+            finally:
+                self.connected = False
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                sock.close()
+
+    def _session(self, sock):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        stream = sock.makefile("rb")
+        try:
+            # Still under create_connection's timeout, so a silent central doesn't hang us here
+            frame = read_frame(stream)
+            if frame is None or frame[0].get("type") != "challenge":
+                raise ConnectionError("central dispatcher sent no challenge")
+            mac = hello_mac(self.secret, frame[0]["nonce"], self.node_id, self.boot)
+            sock.sendall(encode_frame({"type": "hello", "node": self.node_id, "boot": self.boot, "mac": mac}))
+        except BaseException:
+            stream.close()
+            raise
+        sock.settimeout(None)
+        reader = threading.Thread(target=self._read_acks, args=(stream,), name=f"relay-acks-{self.node_id}", daemon=True)
+        reader.start()
+        self.connected = True
+        log.info("Connected to central dispatcher %s:%d", *self.address)
+        # Everything still pending (including alarms sent on a previous connection) goes out again
+        last_sent = 0
+        while reader.is_alive() and not self._stop.is_set():
+            with self._cond:
+                batch = [(seq, item) for seq, item in self.pending.items() if seq > last_sent]
+                if not batch:
+                    self._check_ack_timeout()
+                    self._cond.wait(0.5)
+                    continue
+            for seq, (event, snapshot, height) in batch:
+                with self._cond:
+                    # Recorded before sending, so an ack that beats us here can't leave an orphan entry
+                    if seq in self.pending:
+                        self.sent_at[seq] = time.monotonic()
+                header = {"type": "alarm", "seq": seq, "event": event.to_dict()}
+                if snapshot:
+                    header["snapshot_height"] = height
+                sock.sendall(encode_frame(header, snapshot or b""))
+                last_sent = seq
+
+    def _check_ack_timeout(self):
+        if self.pending:
+            oldest = self.sent_at.get(next(iter(self.pending)))
+            if oldest is not None and time.monotonic() - oldest > ACK_TIMEOUT_S:
+                raise ConnectionError(f"no acknowledgement for {ACK_TIMEOUT_S:.0f} s")
+
+    def _read_acks(self, stream):
+        try:
+            while True:
+                frame = read_frame(stream)
+                if frame is None:
+                    return
+                header, _ = frame
+                if header.get("type") == "ack":
+                    with self._cond:
+                        self.pending.pop(header["seq"], None)
+                        self.sent_at.pop(header["seq"], None)
+                        self._cond.notify_all()
+        except (OSError, ValueError):
+            return
+        finally:
+            stream.close()
+
+
+# ——— Central dispatcher —————————————————————————————————————————————
+class RelayedAlarm:
+    __slots__ = ("node", "event", "snapshot", "snapshot_height", "boot", "seq", "image")
+
+    def __init__(self, node, event, snapshot=None, snapshot_height=None, boot=None, seq=None):
+        self.node = node
+        self.event = event
+        self.snapshot = snapshot
+        self.snapshot_height = snapshot_height
+        self.boot = boot
+        self.seq = seq
+        self.image = None  # left for handle_batch, e.g. to keep an uploaded snapshot across retries
+
+
+class _EdgeHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        dispatcher = self.server.dispatcher
+        try:
+            nonce = secrets.token_hex(16)
+            self.connection.settimeout(HANDSHAKE_TIMEOUT_S)
+            self.send_frame({"type": "challenge", "nonce": nonce})
+            frame = read_frame(self.rfile)
+            if frame is None or frame[0].get("type") != "hello":
+                return
+            node, boot = frame[0]["node"], frame[0]["boot"]
+            if not hmac.compare_digest(str(frame[0].get("mac", "")), hello_mac(dispatcher.secret, nonce, node, boot)):
+                dispatcher.rejected += 1
+                log.warning("Edge node %s from %s failed authentication", node, self.client_address[0],
+                            extra={"fields": {"node": node, "peer": self.client_address[0]}})
+                return
+            self.connection.settimeout(None)
+            log.info("Edge node %s connected from %s", node, self.client_address[0], extra={"fields": {"node": node}})
+            dispatcher.connect(node, boot, self.send_ack)
+            while True:
+                frame = read_frame(self.rfile)
+                if frame is None:
+                    break
+                header, blob = frame
+                if header.get("type") != "alarm":
+                    continue
+                if dispatcher.accept(node, boot, header, blob):
+                    self.send_ack(header["seq"])
+        except (OSError, ValueError) as e:
+            log.warning("Edge connection from %s failed: %s", self.client_address[0], e)
+        except (KeyError, TypeError, AttributeError) as e:
+            # A hello or alarm without node, boot, seq or event, or not a JSON object at all
+            log.warning("Malformed frame from edge %s: %r", self.client_address[0], e)
+
+    def setup(self):
+        super().setup()
+        self.ack_lock = threading.Lock()  # acks come from this thread and from the writer thread
+
+    def send_ack(self, seq):
+        self.send_frame({"type": "ack", "seq": seq})
+
+    def send_frame(self, header):
+        with self.ack_lock:
+            self.wfile.write(encode_frame(header))
+            self.wfile.flush()
+
+
+class CentralDispatcher:
+    """Accepts edge connections and hands alarms, in batches, to a single writer thread.
+
+    handle_batch(list_of_RelayedAlarm) runs on that one thread only, so it can own
+    the Google clients and the next free Alarm Log row without locking. A batch
+    that raises an error retryable(exc) accepts is retried, with backoff, until it
+    is written; any other error hands it to dead_letter(batch, exc) instead. Only
+    then are its alarms acked, on whichever connection each edge is using by then.
+    Only edges that prove they hold `secret` (see hello_mac) are accepted.
+    """
+
+    def __init__(self, handle_batch, secret, host="0.0.0.0", port=RELAY_PORT, batch_max=BATCH_MAX,
+                 batch_wait=BATCH_WAIT_S, retry_s=WRITE_RETRY_S, retryable=lambda exc: True, dead_letter=None):
+        if not secret:
+            raise ValueError("The central dispatcher needs a relay secret.")
+        self.handle_batch = handle_batch
+        self.secret = secret
+        self.retry_s = retry_s
+        self.retryable = retryable
+        self.dead_letter = dead_letter
+        self.batch_max = batch_max
+        self.batch_wait = batch_wait
+        self.queue = queue.Queue()
+        self.last_seq = {}     # (node, boot) -> highest seq queued
+        self.written_seq = {}  # (node, boot) -> highest seq written and acked
+        self.ackers = {}       # (node, boot) -> send_ack of the edge's current connection
+        self.duplicates = 0
+        self.batches = 0
+        self.write_failures = 0
+        self.dead_lettered = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer((host, port), _EdgeHandler, bind_and_activate=False)
+        self.server.allow_reuse_address = True
+        self.server.daemon_threads = True
+        self.server.server_bind()
+        self.server.server_activate()
+        self.server.dispatcher = self
+        self.address = self.server.server_address
+
+    def connect(self, node, boot, send_ack):
+        with self._lock:
+            self.ackers[(node, boot)] = send_ack
+
+    def accept(self, node, boot, header, blob):
+        """Queue an alarm. Returns True for a resend of one already written, which can be acked at once."""
+        seq = header["seq"]
+        with self._lock:
+            if seq <= self.last_seq.get((node, boot), 0):
+                # Still queued or being written: it is acked when that write succeeds
+                self.duplicates += 1
+                return seq <= self.written_seq.get((node, boot), 0)
+            self.last_seq[(node, boot)] = seq
+        event = AlarmEvent.from_dict(header["event"])
+        self.queue.put(RelayedAlarm(node, event, blob or None, header.get("snapshot_height"), boot, seq))
+        return False
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="relay-server", daemon=True).start()
+        threading.Thread(target=self._worker, name="relay-writer", daemon=True).start()
+        log.info("Central dispatcher listening on %s:%d", *self.address)
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def _worker(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_max:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.batches += 1
+            backoff = self.retry_s
+            while True:
+                try:
+                    self.handle_batch(batch)
+                    break
+                except Exception as e:
+                    self.write_failures += 1
+                    if not self.retryable(e):
+                        self._dead_letter(batch, e)
+                        break
+                    log.exception("Central dispatcher failed to log %d alarms, retrying in %.0f s: %s",
+                                  len(batch), backoff, e)
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX_S)
+            self._ack(batch)
+
+    def _dead_letter(self, batch, exc):
+        self.dead_lettered += len(batch)
+        log.error("Central dispatcher gave up on %d alarms after a permanent error: %s", len(batch), exc,
+                  exc_info=exc, extra={"fields": {"alarms": len(batch), "dead_lettered": self.dead_lettered}})
+        if self.dead_letter is not None:
+            try:
+                self.dead_letter(batch, exc)
+            except Exception as e:
+                log.exception("Dead-lettering %d alarms failed: %s", len(batch), e)
+
+    def _ack(self, batch):
+        for item in batch:
+            key = (item.node, item.boot)
+            with self._lock:
+                self.written_seq[key] = max(self.written_seq.get(key, 0), item.seq)
+                send_ack = self.ackers.get(key)
+            try:
+                send_ack(item.seq)
+            except (OSError, ValueError, TypeError):
+                pass  # the edge is reconnecting; it resends and gets the ack from accept()
+
+
+def parse_address(text, default_host="0.0.0.0"):
+    """"host:port", "port" or ":port" -> (host, port)."""
+    host, _, port = text.rpartition(":")
+    return host or default_host, int(port)
+
+
+# ——— Localhost self-test ————————————————————————————————————————————
+_open_sockets = set()
+
+
+class _TrackedHandler(_EdgeHandler):
+    def setup(self):
+        super().setup()
+        _open_sockets.add(self.connection)
+
+    def finish(self):
+        _open_sockets.discard(self.connection)
+        super().finish()
+
+
+class _ConnectionKiller(threading.Thread):
+    """Drops every edge connection now and then to exercise reconnect, resend and dedupe."""
+
+    def __init__(self, interval_s):
+        super().__init__(daemon=True)
+        self.interval_s = interval_s
+        self.kills = 0
+
+    def run(self):
+        while True:
+            time.sleep(self.interval_s)
+            for sock in list(_open_sockets):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                    self.kills += 1
+                except OSError:
+                    pass
+
+
+def selftest(nodes=5, events=200, kill_every=None, fail_every=None):
+    received = []
+    received_lock = threading.Lock()
+    calls = [0]
+
+    def collect(batch):
+        calls[0] += 1
+        if fail_every and calls[0] % fail_every == 0:
+            raise RuntimeError("simulated Sheets quota error")
+        with received_lock:
+            received.extend((item.node, item.event.payload["n"]) for item in batch)
+
+    secret = secrets.token_bytes(32)
+    dispatcher = CentralDispatcher(collect, secret, host="127.0.0.1", port=0, batch_wait=0.05, retry_s=0.05)
+    dispatcher.server.RequestHandlerClass = _TrackedHandler
+    dispatcher.start()
+    killer = None
+    if kill_every:
+        killer = _ConnectionKiller(kill_every)
+        killer.start()
+
+    host, port = dispatcher.address
+    edges = [EdgeForwarder(host, port, f"edge-{i}", secret) for i in range(nodes)]
+    impostor = EdgeForwarder(host, port, "impostor", b"not the relay secret")
+    impostor.submit(AlarmEvent("1", "selftest", payload={"n": 0}))
+    start = time.monotonic()
+
+    def produce(edge):
+        for n in range(events):
+            edge.submit(AlarmEvent(str(n % 6 + 1), "selftest", payload={"n": n}))
+            time.sleep(0.001)
+
+    producers = [threading.Thread(target=produce, args=(edge,)) for edge in edges]
+    for t in producers:
+        t.start()
+    for t in producers:
+        t.join()
+    # Acks follow the write, so once every edge is flushed everything has been logged
+    ok = all(edge.flush(timeout=60) for edge in edges)
+    elapsed = time.monotonic() - start
+
+    expected = {(f"edge-{i}", n) for i in range(nodes) for n in range(events)}
+    with received_lock:
+        got = list(received)
+    missing = expected - set(got)
+    repeated = len(got) - len(set(got))
+    for edge in edges + [impostor]:
+        edge.stop()
+    dispatcher.stop()
+
+    print(f"{nodes} edge nodes x {events} alarms in {elapsed:.2f} s ({len(got) / elapsed:,.0f} alarms/s)")
+    print(f"Batches written: {dispatcher.batches}, failed writes retried: {dispatcher.write_failures}, "
+          f"duplicates suppressed: {dispatcher.duplicates}, connections dropped: {killer.kills if killer else 0}")
+    print(f"Unacknowledged send times left on the edges: {sum(len(edge.sent_at) for edge in edges)}")
+    print(f"Missing: {len(missing)}, delivered twice: {repeated}, "
+          f"impostor connections rejected: {dispatcher.rejected}, impostor alarms logged: {len(set(got) - expected)}")
+    return (ok and not missing and not repeated and not any(edge.sent_at for edge in edges)
+            and dispatcher.rejected > 0 and set(got) <= expected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the edge → central relay against several simulated edge nodes on localhost.")
+    parser.add_argument("--nodes", type=int, default=5)
+    parser.add_argument("--events", type=int, default=200, help="alarms per edge node")
+    parser.add_argument("--kill-every", type=float, default=None, metavar="SECONDS",
+                        help="drop all edge connections at this interval to exercise reconnects")
+    parser.add_argument("--fail-every", type=int, default=None, metavar="N",
+                        help="fail every Nth central write to exercise retry before ack")
+    args = parser.parse_args()
+
+    from Alarm_Logging import setup_logging
+    setup_logging(level=logging.WARNING, fmt="text")
+    raise SystemExit(0 if selftest(args.nodes, args.events, args.kill_every, args.fail_every) else 1)
+
+if __name__ == "__main__":
+    main()
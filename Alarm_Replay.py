@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import statistics
+import threading
+import time
+
+# ——— Capture format ——————————————————————————————————————————————————
+# JSON lines. The first line is a header, every following line is one event
+# with "t" = seconds since the capture started:
+#   {"format": "alarm-capture", "version": 1, "started": 1760851200.0}
+#   {"t": 0.0123, "k": "serial", "data": "3239464631323334..."}      raw bytes, hex
+#   {"t": 0.0125, "k": "edge", "gpio": 17, "level": 0, "tick": 123456}
+CAPTURE_FORMAT = "alarm-capture"
+CAPTURE_VERSION = 1
+FLUSH_EVERY = 256  # events buffered before the capture file is flushed
+TIMEOUT_POLL_S = 1.0  # the S850 monitor calls check_timeout once a second
+
+
+class CaptureWriter:
+    """Records raw serial frames and pigpio edges. Safe to call from the pigpio callback thread."""
+
+    def __init__(self, path):
+        self._file = open(path, "w", encoding="ascii")
+        self._lock = threading.Lock()
+        self._t0 = time.monotonic()
+        self._pending = 0
+        self._write({"format": CAPTURE_FORMAT, "version": CAPTURE_VERSION, "started": time.time()})
+
+    def _write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self._pending += 1
+            if self._pending >= FLUSH_EVERY:
+                self._file.flush()
+                self._pending = 0
+
+    def serial(self, raw_bytes):
+        self._write({"t": round(time.monotonic() - self._t0, 6), "k": "serial", "data": raw_bytes.hex()})
+
+    def edge(self, gpio, level, tick):
+        self._write({"t": round(time.monotonic() - self._t0, 6), "k": "edge", "gpio": gpio, "level": level, "tick": tick})
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_capture(path):
+    """Yield (t, kind, record) for every event in a capture file."""
+    with open(path, encoding="ascii") as f:
+        header = json.loads(f.readline())
+        if header.get("format") != CAPTURE_FORMAT:
+            raise ValueError(f"{path} is not an alarm capture file.")
+        if header.get("version") != CAPTURE_VERSION:
+            raise ValueError(f"Unsupported capture version {header.get('version')} in {path}.")
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record["k"] == "serial":
+                record["data"] = bytes.fromhex(record["data"])
+            yield record["t"], record["k"], record
+
+
+# ——— Replay engine ———————————————————————————————————————————————————
+class ReplayStats:
+    def __init__(self):
+        self.events = {"serial": 0, "edge": 0}
+        self.decoded = {"serial_frames": 0, "serial_errors": 0, "s850_state_changes": 0, "s850_alarms": 0}
+        self.cpu_ns = {"serial": [], "edge": []}
+        self.wall_s = 0.0
+        self.capture_span_s = 0.0
+
+    def report(self):
+        total = sum(self.events.values())
+        lines = [
+            f"Replayed {total} events ({self.events['serial']} serial, {self.events['edge']} edges) "
+            f"spanning {self.capture_span_s:.3f} s of capture in {self.wall_s:.3f} s wall",
+            f"Throughput: {total / self.wall_s if self.wall_s else 0:,.0f} events/s",
+            "Decoded: " + ", ".join(f"{k}={v}" for k, v in self.decoded.items()),
+        ]
+        for kind, samples in self.cpu_ns.items():
+            if not samples:
+                continue
+            samples = sorted(samples)
+            p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+            lines.append(
+                f"CPU per {kind} event: mean {statistics.fmean(samples) / 1000:.2f} µs, "
+                f"p50 {samples[len(samples) // 2] / 1000:.2f} µs, p99 {p99 / 1000:.2f} µs"
+            )
+        return "\n".join(lines)
+
+
+def replay(path, speed=None, verbose=False):
+    """Feed a capture through parse_message and the S850 edge logic.
+
+    speed=None replays as fast as possible; speed=1.0 keeps the captured timing.
+    The monitor's once-a-second check_timeout poll is replayed too, on a pigpio
+    tick derived from the last edge's tick plus the capture time elapsed since it,
+    so a line that goes quiet is reported even when no further edge arrives.
+    """
+    import Alarm_Node_Reader
+    import S850
+
+    S850.reset_state()
+    stats = ReplayStats()
+    start = time.monotonic()
+    t = 0.0
+    anchor = None  # (t, tick) of the last edge
+    next_poll = None
+
+    def poll(until):
+        nonlocal next_poll
+        while next_poll is not None and next_poll <= until:
+            edge_t, edge_tick = anchor
+            tick = (edge_tick + round((next_poll - edge_t) * 1_000_000)) & 0xFFFFFFFF
+            if S850.check_timeout(tick):
+                stats.decoded["s850_alarms"] += 1
+            next_poll += TIMEOUT_POLL_S
+
+    for t, kind, record in read_capture(path):
+        if speed:
+            delay = start + t / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        poll(t)
+        stats.events[kind] += 1
+        if kind == "serial":
+            t0 = time.thread_time_ns()
+            entry = Alarm_Node_Reader.parse_message(record["data"])
+            stats.cpu_ns["serial"].append(time.thread_time_ns() - t0)
+            if entry is None:
+                continue
+            if entry.startswith("Parse Error"):
+                stats.decoded["serial_errors"] += 1
+            else:
+                stats.decoded["serial_frames"] += 1
+            if verbose:
+                print(entry)
+        elif kind == "edge":
+            before = S850.current_state
+            t0 = time.thread_time_ns()
+            alarm = S850.check_timeout(record["tick"])
+            S850.edge_cb(record["gpio"], record["level"], record["tick"])
+            stats.cpu_ns["edge"].append(time.thread_time_ns() - t0)
+            if alarm:
+                stats.decoded["s850_alarms"] += 1
+            if S850.current_state != before:
+                stats.decoded["s850_state_changes"] += 1
+            anchor = (t, record["tick"])
+            if next_poll is None:
+                next_poll = t + TIMEOUT_POLL_S
+    if anchor is not None:
+        # Once more as the capture stops, like the monitor's last poll before it was stopped
+        next_poll = t
+        poll(t)
+    stats.wall_s = time.monotonic() - start
+    stats.capture_span_s = t
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded serial/S850 capture through the decoders.")
+    parser.add_argument("capture", help="capture file written with --record")
+    parser.add_argument("--realtime", action="store_true", help="keep the captured timing instead of replaying at full speed")
+    parser.add_argument("--speed", type=float, default=None, help="timing multiplier, e.g. 10 for 10x real time")
+    parser.add_argument("--verbose", action="store_true", help="print decoded entries and S850 state changes")
+    args = parser.parse_args()
+
+    from Alarm_Logging import setup_logging
+    setup_logging(level=logging.INFO if args.verbose else logging.WARNING, fmt="text")
+    speed = args.speed or (1.0 if args.realtime else None)
+    print(replay(args.capture, speed=speed, verbose=args.verbose).report())
+
+if __name__ == "__main__":
+    main()
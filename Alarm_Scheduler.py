@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import heapq
+import itertools
+import logging
+import threading
+
+from Alarm_Core import DEFAULT_PRIORITY, PRIORITY_CLASSES
+
+log = logging.getLogger("alarm")
+
+# ——— Configuration ——————————————————————————————————————————————————
+# How long an alarm of each class may wait before it is logged without a snapshot
+# to catch up. None means never degrade.
+LATENCY_BUDGET_S = {"critical": None, "high": 30.0, "normal": 15.0, "low": 5.0}
+WORKERS = 2               # take any alarm, most urgent first
+EXPRESS_WORKERS = 1       # only take alarms up to EXPRESS_MAX_PRIORITY, so those never queue behind uploads
+EXPRESS_MAX_PRIORITY = "high"
+
+
+class AlarmScheduler:
+    """Priority queue between the monitors and handle_alarm.
+
+    submit() never blocks, so a monitor goes straight back to watching its source.
+    Workers always take the most urgent queued alarm. handle(event, degrade=...)
+    is expected to call degrade() before each slow stage and skip the snapshot
+    when it returns True, which happens once the alarm's latency budget is spent
+    or when a more urgent alarm is waiting for a worker.
+    """
+
+    def __init__(self, handle, alarm_table, workers=WORKERS, express_workers=EXPRESS_WORKERS):
+        self.handle = handle
+        self.alarm_table = alarm_table
+        self.express_rank = PRIORITY_CLASSES.index(EXPRESS_MAX_PRIORITY)
+        self.degraded = 0
+        self._heap = []  # (rank, seq, event)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        for i in range(workers):
+            threading.Thread(target=self._work, args=(len(PRIORITY_CLASSES),), name=f"alarm-worker-{i}", daemon=True).start()
+        for i in range(express_workers):
+            threading.Thread(target=self._work, args=(self.express_rank,), name=f"alarm-express-{i}", daemon=True).start()
+
+    def priority(self, event):
+        station = self.alarm_table.get(event.contact_id)
+        return station.priority if station else DEFAULT_PRIORITY
+
+    def submit(self, event):
+        rank = PRIORITY_CLASSES.index(self.priority(event))
+        with self._cond:
+            heapq.heappush(self._heap, (rank, next(self._seq), event))
+            self._cond.notify_all()
+
+    def queue_depth(self):
+        return len(self._heap)
+
+    def _work(self, max_rank):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > max_rank:
+                    self._cond.wait()
+                rank, _, event = heapq.heappop(self._heap)
+            try:
+                self.handle(event, degrade=self._degrader(rank, event))
+            except Exception as e:
+                log.exception("Alarm worker failed on Contact ID %s: %s", event.contact_id, e)
+
+    def _degrader(self, rank, event):
+        budget = LATENCY_BUDGET_S.get(PRIORITY_CLASSES[rank])
+        decided = []
+
+        def degrade():
+            if decided:
+                return True
+            reason = None
+            if budget is not None and event.age() > budget:
+                reason = "latency budget exceeded"
+            elif rank > 0 and self._heap and self._heap[0][0] < rank:
+                # Anything more urgent still queued means no eligible worker is free
+                reason = "preempted by a more urgent alarm"
+            if reason is None:
+                return False
+            decided.append(reason)
+            self.degraded += 1
+            log.warning("Logging Contact ID %s without snapshot: %s", event.contact_id, reason,
+                        extra={"fields": {"contact_id": event.contact_id, "priority": PRIORITY_CLASSES[rank],
+                                          "age_s": round(event.age(), 3), "reason": reason}})
+            return True
+
+        return degrade
@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+
+from Alarm_Core import AlarmEvent, AlarmStation
+from Alarm_Health import health
+
+log = logging.getLogger("alarm")
+
+# ——— Configuration ——————————————————————————————————————————————————
+SINK_QUEUE_SIZE = 10_000   # per sink; a sink this far behind drops new alarms rather than block the others
+SINK_BATCH_MAX = 256       # items handed to one write_batch call
+SINK_IDLE_S = 0.5          # a sink with nothing queued this long gets idle() to flush
+FSYNC_EVERY = 64           # FileSink fsyncs after this many records...
+FSYNC_INTERVAL_S = 1.0     # ...or this long after the oldest unsynced one, whichever comes first
+PRUNE_TO = 0.9             # a capped SnapshotStore prunes down to this share of its cap
+
+
+# ——— Sink items ———————————————————————————————————————————————————————
+@dataclass(slots=True)
+class LoggedAlarm:
+    """One handled alarm as every sink receives it.
+
+    snapshot is the JPEG logged with the row (a contact sheet for several cameras),
+    or None for a degraded alarm. late_cameras lists cameras that missed the
+    snapshot deadline; each arrives later as a LateSnapshot for this alarm.
+    """
+    station: AlarmStation
+    event: AlarmEvent
+    snapshot: bytes = None
+    snapshot_height: int = None
+    late_cameras: tuple = ()
+    sha256: str = field(default=None, repr=False)  # computed once, by whichever sink asks first
+
+    def snapshot_sha256(self):
+        if self.sha256 is None and self.snapshot:
+            self.sha256 = hashlib.sha256(self.snapshot).hexdigest()
+        return self.sha256
+
+
+@dataclass(slots=True)
+class LateSnapshot:
+    alarm: LoggedAlarm
+    camera_id: str
+    snapshot: bytes
+    snapshot_height: int
+    sha256: str = field(default=None, repr=False)
+
+    def snapshot_sha256(self):
+        if self.sha256 is None and self.snapshot:
+            self.sha256 = hashlib.sha256(self.snapshot).hexdigest()
+        return self.sha256
+
+
+# ——— Sink interface ——————————————————————————————————————————————————
+class AlarmSink:
+    """Somewhere handled alarms are logged.
+
+    Each sink runs on its own thread behind SinkFanout, so write methods may block
+    and need no locking; items arrive in submit order, so a LateSnapshot always
+    comes after its alarm. A failure only loses the item it happened on: it is
+    counted in the sink's errors and the sink carries on with the next one.
+    """
+    name = "sink"
+
+    def write(self, alarm):
+        raise NotImplementedError
+
+    def write_late(self, late):
+        """Handle a snapshot that arrived after its alarm was written. Ignored by default."""
+
+    def write_batch(self, items):
+        """Write items one by one; returns [(item, exception)] for those that failed.
+
+        Backends that write a whole batch at once may override this and raise
+        instead; the batch is then retried through this method, item by item.
+        """
+        failed = []
+        for item in items:
+            try:
+                if isinstance(item, LateSnapshot):
+                    self.write_late(item)
+                else:
+                    self.write(item)
+            except Exception as e:
+                failed.append((item, e))
+        return failed
+
+    def idle(self):
+        """Called when nothing has been queued for SINK_IDLE_S."""
+
+    def close(self):
+        self.idle()
+
+
+class FileSink(AlarmSink):
+    """Append-only JSONL or CSV alarm log on local disk.
+
+    A batch is written with one write() call; fsync runs every FSYNC_EVERY records
+    or FSYNC_INTERVAL_S, and when the sink goes idle, so a burst costs a handful of
+    fsyncs instead of one per alarm. Snapshots are recorded by their sha256, which
+    is their key in a SnapshotStore.
+    """
+
+    def __init__(self, path, fmt=None, name=None):
+        self.fmt = fmt or ("csv" if path.endswith(".csv") else "jsonl")
+        if self.fmt not in ("jsonl", "csv"):
+            raise ValueError(f"Unknown file sink format {self.fmt!r}; expected 'jsonl' or 'csv'.")
+        self.name = name or self.fmt
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8", newline="")
+        self._unsynced = 0
+        self._first_unsynced = None
+
+    def _record(self, item):
+        if isinstance(item, LateSnapshot):
+            alarm = item.alarm
+            kind, camera_ids, sha = "late_snapshot", (item.camera_id,), item.snapshot_sha256()
+        else:
+            alarm = item
+            kind, camera_ids, sha = "alarm", alarm.station.camera_ids, alarm.snapshot_sha256()
+        event, station = alarm.event, alarm.station
+        if self.fmt == "csv":
+            return [kind, event.timestamp(), event.contact_id, event.source, *station.labels,
+                    " ".join(camera_ids), sha or ""]
+        return {"kind": kind, "timestamp": event.timestamp(), "wall_time": event.wall_time,
+                "contact_id": event.contact_id, "source": event.source, "labels": list(station.labels),
+                "priority": station.priority, "camera_ids": list(camera_ids), "snapshot_sha256": sha,
+                "late_cameras": list(alarm.late_cameras) if kind == "alarm" else None,
+                "payload": event.payload}
+
+    def _encode(self, items):
+        if self.fmt == "csv":
+            out = io.StringIO()
+            csv.writer(out).writerows(self._record(item) for item in items)
+            return out.getvalue()
+        return "".join(json.dumps(self._record(item), separators=(",", ":")) + "\n" for item in items)
+
+    def write(self, alarm):
+        self.write_batch([alarm])
+
+    def write_late(self, late):
+        self.write_batch([late])
+
+    def write_batch(self, items):
+        self._file.write(self._encode(items))
+        self._file.flush()
+        if self._first_unsynced is None:
+            self._first_unsynced = time.monotonic()
+        self._unsynced += len(items)
+        if self._unsynced >= FSYNC_EVERY or time.monotonic() - self._first_unsynced >= FSYNC_INTERVAL_S:
+            self._sync()
+
+    def _sync(self):
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+            self._first_unsynced = None
+
+    def idle(self):
+        self._sync()
+
+    def close(self):
+        self._sync()
+        self._file.close()
+
+
+class SnapshotStore(AlarmSink):
+    """Content-addressed snapshot files: <root>/<sha256[:2]>/<sha256>.jpg.
+
+    Identical snapshots are stored once. Files are written to a temporary name and
+    renamed, so a crash never leaves a partial file under a valid name. With
+    max_bytes set, the oldest files are deleted whenever the store grows past it,
+    down to PRUNE_TO of the cap.
+    """
+    name = "snapshots"
+
+    def __init__(self, root, fsync=True, max_bytes=None):
+        self.root = root
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self.total_bytes = sum(size for _, size, _ in self._files()) if max_bytes else 0
+
+    def _files(self):
+        """(mtime, size, path) of every stored snapshot."""
+        for shard in os.scandir(self.root):
+            if shard.is_dir():
+                for entry in os.scandir(shard.path):
+                    if entry.name.endswith(".jpg"):
+                        st = entry.stat()
+                        yield st.st_mtime, st.st_size, entry.path
+
+    def prune(self):
+        """Delete the oldest snapshots until the store is under PRUNE_TO of max_bytes."""
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        target = self.max_bytes * PRUNE_TO
+        removed = 0
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        self.total_bytes = total
+        log.info("Pruned %d snapshots from %s", removed, self.root,
+                 extra={"fields": {"removed": removed, "bytes": total}})
+
+    def path_for(self, sha256):
+        return os.path.join(self.root, sha256[:2], f"{sha256}.jpg")
+
+    def put(self, data, sha256=None):
+        """Store data and return its sha256."""
+        sha256 = sha256 or hashlib.sha256(data).hexdigest()
+        path = self.path_for(sha256)
+        if os.path.exists(path):
+            os.utime(path)  # still referenced, so pruned last
+            return sha256
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        if self.max_bytes:
+            self.total_bytes += len(data)
+            if self.total_bytes > self.max_bytes:
+                self.prune()
+        return sha256
+
+    def get(self, sha256):
+        with open(self.path_for(sha256), "rb") as f:
+            return f.read()
+
+    def write(self, alarm):
+        if alarm.snapshot:
+            self.put(alarm.snapshot, alarm.snapshot_sha256())
+
+    def write_late(self, late):
+        if late.snapshot:
+            self.put(late.snapshot, late.snapshot_sha256())
+
+
+# ——— Fan-out ———————————————————————————————————————————————————————————
+class _SinkRunner:
+    __slots__ = ("sink", "queue", "thread", "written", "dropped", "errors")
+
+    def __init__(self, sink, queue_size):
+        self.sink = sink
+        self.queue = queue.Queue(queue_size)
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.thread = threading.Thread(target=self._run, name=f"sink-{sink.name}", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=SINK_IDLE_S)
+            except queue.Empty:
+                self._call(self.sink.idle)
+                continue
+            batch = []
+            stop = item is None  # close() sentinel
+            while not stop:
+                batch.append(item)
+                if len(batch) >= SINK_BATCH_MAX:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                stop = item is None
+            if batch:
+                self._write(batch)
+            for _ in range(len(batch) + stop):
+                self.queue.task_done()
+            if stop:
+                self._call(self.sink.close)
+                return
+
+    def _write(self, batch):
+        # written, errors and dropped all count items, so they add up to what was submitted
+        try:
+            failed = self.sink.write_batch(batch) or []
+        except Exception as e:
+            log.warning("Alarm sink %s failed a batch of %d, retrying item by item: %s", self.sink.name,
+                        len(batch), e, extra={"fields": {"sink": self.sink.name, "items": len(batch)}})
+            failed = AlarmSink.write_batch(self.sink, batch)
+        self.written += len(batch) - len(failed)
+        if failed:
+            self.errors += len(failed)
+            for _, e in failed:
+                health.error(f"sink_{self.sink.name}", e)
+            log.error("Alarm sink %s failed %d of %d items: %s", self.sink.name, len(failed), len(batch), failed[-1][1],
+                      extra={"fields": {"sink": self.sink.name, "failed": len(failed), "errors": self.errors}})
+
+    def _call(self, fn):
+        # idle() and close(): a failure here is reported but loses no item
+        try:
+            fn()
+        except Exception as e:
+            health.error(f"sink_{self.sink.name}", e)
+            log.error("Alarm sink %s failed: %s", self.sink.name, e, extra={"fields": {"sink": self.sink.name}})
+
+
+class SinkFanout:
+    """Hands every alarm to each sink's own queue and thread.
+
+    submit() never blocks: a sink that falls SINK_QUEUE_SIZE items behind drops
+    new items (counted in dropped) instead of slowing the handler or the other sinks.
+    """
+
+    def __init__(self, sinks, queue_size=SINK_QUEUE_SIZE):
+        names = [sink.name for sink in sinks]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Sink names must be unique: {names}")
+        self.runners = [_SinkRunner(sink, queue_size) for sink in sinks]
+
+    def submit(self, item):
+        for runner in self.runners:
+            try:
+                runner.queue.put_nowait(item)
+            except queue.Full:
+                runner.dropped += 1
+                if runner.dropped == 1 or runner.dropped % 1000 == 0:
+                    log.error("Alarm sink %s is %d items behind; dropped %d so far", runner.sink.name,
+                              runner.queue.maxsize, runner.dropped,
+                              extra={"fields": {"sink": runner.sink.name, "dropped": runner.dropped}})
+
+    def drain(self):
+        """Block until every sink has handled everything submitted so far."""
+        for runner in self.runners:
+            runner.queue.join()
+
+    def close(self):
+        for runner in self.runners:
+            runner.queue.put(None)
+        for runner in self.runners:
+            runner.thread.join()
+
+    def register_metrics(self, registry=health):
+        for runner in self.runners:
+            name = runner.sink.name
+            registry.gauge(f"sink_{name}_queue_depth", runner.queue.qsize)
+            registry.counter(f"sink_{name}_written", lambda runner=runner: runner.written)
+            registry.counter(f"sink_{name}_dropped", lambda runner=runner: runner.dropped)
+            registry.counter(f"sink_{name}_errors", lambda runner=runner: runner.errors)
+
+
+# ——— Benchmark ————————————————————————————————————————————————————————
+class _SlowSink(AlarmSink):
+    """Stands in for a sink stuck on the network, to show it doesn't hold up the rest."""
+    name = "slow"
+
+    def __init__(self, delay_s):
+        self.delay_s = delay_s
+
+    def write(self, alarm):
+        time.sleep(self.delay_s)
+
+
+def _bench_items(count, snapshot_kb, distinct):
+    station = AlarmStation("1", ("Site", "Location", "Floor", "Zone", "Table", "Unit 1"), ("cam-1a", "cam-1b"))
+    # distinct payloads, so the snapshot store writes real files rather than deduplicating them all
+    snapshots = [os.urandom(snapshot_kb * 1024) for _ in range(distinct)]
+    return [LoggedAlarm(station, AlarmEvent("1", "bench"), snapshots[i % distinct], 240) for i in range(count)]
+
+
+def bench(sinks, count=10_000, snapshot_kb=60, distinct=1000):
+    """Run count alarms through all sinks at once.
+
+    Returns (seconds spent submitting, {name: (alarms/s, seconds to finish, errors)}).
+    """
+    items = _bench_items(count, snapshot_kb, distinct)
+    fanout = SinkFanout(sinks, queue_size=count + 1)
+    finished = {}
+    start = time.perf_counter()
+    for item in items:
+        fanout.submit(item)
+    submit_s = time.perf_counter() - start
+
+    def finish(runner):
+        runner.queue.join()
+        finished[runner.sink.name] = time.perf_counter()
+
+    # Each sink is timed on its own, finishing whenever its queue empties, whatever the others are doing
+    waiters = [threading.Thread(target=finish, args=(runner,)) for runner in fanout.runners]
+    for waiter in waiters:
+        waiter.start()
+    for waiter in waiters:
+        waiter.join()
+    results = {}
+    for runner in fanout.runners:
+        name = runner.sink.name
+        elapsed = finished[name] - start
+        results[name] = (runner.written / elapsed if elapsed else 0.0, elapsed, runner.errors)
+    fanout.close()
+    return submit_s, results
+
+
+# ——— Self-test ————————————————————————————————————————————————————————
+class _FlakySink(AlarmSink):
+    """Fails item fail_at, e.g. a Sheets 429 in the middle of a storm; batch_level also fails its first batch whole."""
+
+    def __init__(self, name, fail_at, gate, batch_level=False):
+        self.name = name
+        self.fail_at = fail_at
+        self.gate = gate
+        self.batch_level = batch_level
+        self.written = []
+
+    def write(self, alarm):
+        if alarm.event.payload["n"] == self.fail_at:
+            raise RuntimeError(f"simulated failure on item {self.fail_at}")
+        self.written.append(alarm.event.payload["n"])
+
+    def write_batch(self, items):
+        self.gate.wait()
+        if self.batch_level and len(items) > 1:
+            self.batch_level = False
+            raise RuntimeError("simulated batch failure")
+        return super().write_batch(items)
+
+
+def selftest(alarms=50, fail_at=7):
+    """A failing item must lose only itself, and written + errors + dropped must add up to what was submitted."""
+    station = AlarmStation("1", ("Site",), ("cam-1",))
+    gate = threading.Event()
+    fanout = SinkFanout([_FlakySink("per-item", fail_at, gate), _FlakySink("batch", fail_at, gate, batch_level=True)])
+    # Item 0 holds each sink in write_batch until the rest are queued, so they arrive as one batch
+    for n in range(alarms):
+        fanout.submit(LoggedAlarm(station, AlarmEvent("1", "selftest", payload={"n": n})))
+        if n == 0:
+            time.sleep(0.1)
+    gate.set()
+    fanout.drain()
+    ok = True
+    for runner in fanout.runners:
+        lost = sorted(set(range(alarms)) - set(runner.sink.written))
+        passed = (runner.written, runner.errors, runner.dropped, lost) == (alarms - 1, 1, 0, [fail_at])
+        ok &= passed
+        print(f"{runner.sink.name:>9}: written {runner.written}  errors {runner.errors}  dropped {runner.dropped}  "
+              f"lost {lost}  {'ok' if passed else 'FAIL'}")
+    fanout.close()
+    print("PASS" if ok else "FAIL")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure per-sink throughput with every sink running side by side.")
+    parser.add_argument("--selftest", action="store_true",
+                        help="instead, check that a failing item loses only itself and is counted")
+    parser.add_argument("--alarms", type=int, default=10_000)
+    parser.add_argument("--snapshot-kb", type=int, default=60, help="size of each synthetic snapshot")
+    parser.add_argument("--distinct", type=int, default=1000, help="distinct snapshots among the alarms")
+    parser.add_argument("--dir", help="where the file sinks write (default: a temporary directory)")
+    parser.add_argument("--slow-ms", type=float, default=0.0,
+                        help="also run a sink that takes this long per alarm, to check it holds nobody up")
+    args = parser.parse_args()
+
+    if args.selftest:
+        raise SystemExit(0 if selftest() else 1)
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.dir or tmp
+        factories = {
+            "jsonl": lambda run: FileSink(os.path.join(root, f"alarms-{run}.jsonl")),
+            "csv": lambda run: FileSink(os.path.join(root, f"alarms-{run}.csv")),
+            "snapshots": lambda run: SnapshotStore(os.path.join(root, f"snapshots-{run}")),
+        }
+        if args.slow_ms:
+            factories["slow"] = lambda run: _SlowSink(args.slow_ms / 1000)
+        # Alone is each backend's own speed; together shows they share one CPU (and the GIL) but not a queue
+        alone = {name: bench([make("alone")], args.alarms, args.snapshot_kb, args.distinct)[1][name]
+                 for name, make in factories.items()}
+        submit_s, together = bench([make("together") for make in factories.values()],
+                                   args.alarms, args.snapshot_kb, args.distinct)
+        print(f"submit: {args.alarms / submit_s:,.0f} alarms/s into {len(factories)} queues")
+        print(f"{'sink':>10} {'alone/s':>10} {'together/s':>11} {'seconds':>8} {'errors':>7}")
+        for name, (rate, elapsed, errors) in together.items():
+            print(f"{name:>10} {alone[name][0]:>10,.0f} {rate:>11,.0f} {elapsed:>8.2f} {errors + alone[name][2]:>7}")
+
+if __name__ == "__main__":
+    main()
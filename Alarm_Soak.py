@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+import argparse
+import ctypes
+import datetime
+import functools
+import gc
+import io
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import socket
+import socketserver
+import ssl
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+import googleapiclient.discovery
+import pigpio
+from PIL import Image
+
+import Alarm_Integration_Consolidated as integration
+from Alarm_Core import AlarmEvent, AlarmStation
+from Alarm_Health import health
+from Alarm_Logging import setup_logging
+from Alarm_Partitions import INDEX_SHEET_NAME
+from Alarm_Sinks import FileSink, SinkFanout, SnapshotStore
+
+log = logging.getLogger("soak")
+
+# ——— Configuration ——————————————————————————————————————————————————
+SAMPLE_EVERY_S = 30.0
+WARMUP_FRACTION = 0.1        # growth is measured from the first sample after this share of the alarms
+MAX_RSS_GROWTH_MB = 20.0
+MAX_FD_GROWTH = 5
+MAX_THREAD_GROWTH = 2
+TOP_ALLOCATORS = 10
+
+
+# ——— Local network services ———————————————————————————————————————
+# The camera API, the OAuth token endpoint, Sheets, Drive and pigpiod, served on
+# 127.0.0.1 so the real requests, google-auth, googleapiclient/httplib2 and pigpio
+# clients open real sockets for every alarm. The spreadsheet only keeps row and
+# grid counts per tab, so any growth the soak sees is on the client side.
+PIGPIO_SOCK_CMD_LEN = 16
+PIGPIO_CMD_BR1 = 10
+PIGPIO_CMD_TICK = 16
+PIGPIO_CMD_NB = 19
+PIGPIO_CMD_NC = 21
+PIGPIO_CMD_NOIB = 99
+
+
+class _Spreadsheet:
+    """Tabs as [sheetId, rows written, grid rows, grid columns]; enforces the grid like Sheets does."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tabs = {title: [n, 0, 1000, 26] for n, title in
+                     enumerate((integration.ALARM_LOG_SHEET_NAME, integration.CREDENTIALS_SHEET_NAME))}
+
+    def _tab(self, range_):
+        return self.tabs[range_.split("!")[0].strip("'").replace("''", "'")]
+
+    def _by_id(self, sheet_id):
+        return next(tab for tab in self.tabs.values() if tab[0] == sheet_id)
+
+    def metadata(self):
+        with self.lock:
+            return {"sheets": [{"properties": {"title": title, "sheetId": sheet_id,
+                                               "gridProperties": {"rowCount": grid_rows, "columnCount": grid_columns}}}
+                               for title, (sheet_id, _, grid_rows, grid_columns) in self.tabs.items()]}
+
+    def column(self, range_):
+        with self.lock:
+            return {"range": range_, "values": [["x"]] * self._tab(range_)[1]}
+
+    def write(self, range_, values, append=False):
+        with self.lock:
+            tab = self._tab(range_)
+            tab[1] = tab[1] + len(values) if append else max(tab[1], len(values))
+        return {}
+
+    def batch_update(self, requests_):
+        replies = []
+        with self.lock:
+            for request in requests_:
+                reply = {}
+                if "addSheet" in request:
+                    properties = request["addSheet"]["properties"]
+                    if properties["title"] in self.tabs:
+                        raise ValueError(f"A sheet with the name \"{properties['title']}\" already exists.")
+                    grid = properties.get("gridProperties", {})
+                    sheet_id = 100 + len(self.tabs)
+                    self.tabs[properties["title"]] = [sheet_id, 0, grid.get("rowCount", 1000), grid.get("columnCount", 26)]
+                    reply = {"addSheet": {"properties": {"sheetId": sheet_id, "title": properties["title"]}}}
+                elif "appendDimension" in request:
+                    self._by_id(request["appendDimension"]["sheetId"])[2] += request["appendDimension"]["length"]
+                elif "updateCells" in request:
+                    start = request["updateCells"]["start"]
+                    tab = self._by_id(start["sheetId"])
+                    width = len(request["updateCells"]["rows"][0]["values"])
+                    if start["rowIndex"] >= tab[2] or start["columnIndex"] + width > tab[3]:
+                        raise ValueError(f"Range ({start}) exceeds grid limits. Max rows: {tab[2]}, max columns: {tab[3]}")
+                    tab[1] = max(tab[1], start["rowIndex"] + 1)
+                replies.append(reply)
+        return {"replies": replies}
+
+    def logged_rows(self):
+        """Data rows in the Alarm Log partitions, header rows and the index sheet left out."""
+        with self.lock:
+            return sum(max(rows - 1, 0) for title, (_, rows, _, _) in self.tabs.items()
+                       if title.startswith(integration.ALARM_LOG_SHEET_NAME + " ") and title != INDEX_SHEET_NAME)
+
+
+class _ServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real endpoints
+
+    def do_GET(self):
+        self._respond()
+
+    def do_POST(self):
+        self._respond()
+
+    def do_PUT(self):
+        self._respond()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            status, payload, content_type = self.server.services.route(self.command, urlsplit(self.path), body)
+        except Exception as e:
+            status, content_type = 400, "application/json"
+            payload = json.dumps({"error": {"code": 400, "message": str(e), "status": "INVALID_ARGUMENT"}}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class LocalServices:
+    """Serves the Google endpoints over HTTP and the camera over HTTPS with a self-signed certificate."""
+
+    def __init__(self, directory, width=1280, height=720):
+        buffer = io.BytesIO()
+        Image.new("RGB", (width, height), (90, 120, 150)).save(buffer, format="JPEG")
+        self.jpeg = buffer.getvalue()
+        self.spreadsheet = _Spreadsheet()
+        self.uploads = itertools.count(1)
+        self.key_file, self.cert_file = _self_signed(directory)
+        self.google = self._serve()
+        self.camera = self._serve()
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.cert_file, self.key_file)
+        self.camera.socket = context.wrap_socket(self.camera.socket, server_side=True)
+        for server in (self.google, self.camera):
+            threading.Thread(target=server.serve_forever, name="soak-services", daemon=True).start()
+        self.google_url = "http://127.0.0.1:%d/" % self.google.server_address[1]
+        self.camera_host = "127.0.0.1:%d" % self.camera.server_address[1]
+
+    def _serve(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _ServiceHandler)
+        server.daemon_threads = True
+        server.services = self
+        return server
+
+    def route(self, method, url, body):
+        path = unquote(url.path)
+        if path == "/token":
+            return self._json({"access_token": "soak", "expires_in": 3600, "token_type": "Bearer"})
+        if path.startswith("/discovery/"):
+            return 200, self._discovery(*path.split("/")[2:4]), "application/json"
+        if path == "/api/v3.0/media/liveImage.jpeg":
+            return 200, self.jpeg, "image/jpeg"
+        if path == "/upload/drive/v3/files":
+            return self._json({"id": f"soak-{next(self.uploads)}"})
+        if re.fullmatch(r"/drive/v3/files/[^/]+/permissions", path):
+            return self._json({"id": "anyoneWithLink", "type": "anyone", "role": "reader"})
+        match = re.fullmatch(r"/v4/spreadsheets/[^/]+?(?::batchUpdate|/values/(.+?)(:append)?)?", path)
+        if not match:
+            return 404, b"{}", "application/json"
+        range_, append = match.groups()
+        if path.endswith(":batchUpdate"):
+            return self._json(self.spreadsheet.batch_update(json.loads(body)["requests"]))
+        if range_ is None:
+            return self._json(self.spreadsheet.metadata())
+        if method == "GET":
+            return self._json(self.spreadsheet.column(range_))
+        return self._json(self.spreadsheet.write(range_, json.loads(body)["values"], append=bool(append)))
+
+    @functools.lru_cache(maxsize=None)
+    def _discovery(self, api, version):
+        # The bundled document, rooted here; unlike client_options' api_endpoint this also moves media uploads
+        with open(os.path.join(os.path.dirname(googleapiclient.discovery.__file__), "discovery_cache",
+                               "documents", f"{api}.{version}.json")) as f:
+            document = json.load(f)
+        document["rootUrl"] = document["mtlsRootUrl"] = self.google_url
+        return json.dumps(document).encode()
+
+    @staticmethod
+    def _json(payload):
+        return 200, json.dumps(payload).encode(), "application/json"
+
+    def service_account_file(self, directory):
+        """A service account key for this server's token endpoint, for Credentials.from_service_account_file."""
+        with open(self.key_file) as f:
+            private_key = f.read()
+        path = os.path.join(directory, "service-account.json")
+        with open(path, "w") as f:
+            json.dump({"type": "service_account", "project_id": "soak", "private_key_id": "soak",
+                       "private_key": private_key, "client_email": "soak@soak.iam.gserviceaccount.com",
+                       "client_id": "1", "token_uri": self.google_url + "token"}, f)
+        return path
+
+    def close(self):
+        for server in (self.google, self.camera):
+            server.shutdown()
+            server.server_close()
+
+
+def _self_signed(directory):
+    """Write a key and a certificate for 127.0.0.1; the key doubles as the service account's."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=30))
+            .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]),
+                           critical=False)
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+            .sign(key, hashes.SHA256()))
+    key_file, cert_file = os.path.join(directory, "soak-key.pem"), os.path.join(directory, "soak-cert.pem")
+    with open(key_file, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    with open(cert_file, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    return key_file, cert_file
+
+
+class _PigpiodHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            command = self.request.recv(PIGPIO_SOCK_CMD_LEN, socket.MSG_WAITALL)
+            if len(command) < PIGPIO_SOCK_CMD_LEN:
+                return
+            cmd, p1, p2, p3 = struct.unpack("IIII", command)
+            if p3:
+                self.request.recv(p3, socket.MSG_WAITALL)
+            if cmd == PIGPIO_CMD_NC:
+                self.server.close_notify(p1)  # sent on the notification socket, which closes without a reply
+                return
+            res = 0
+            if cmd == PIGPIO_CMD_BR1:
+                res = self.server.levels
+            elif cmd == PIGPIO_CMD_TICK:
+                res = self.server.tick
+            elif cmd == PIGPIO_CMD_NOIB:
+                res = self.server.open_notify(self.request)
+            elif cmd == PIGPIO_CMD_NB:
+                self.server.watch(p1, p2)
+            self.request.sendall(struct.pack("IIII", cmd, p1, p2, res))
+
+
+class Pigpiod(socketserver.ThreadingTCPServer):
+    """Enough of the pigpiod socket protocol for the S850 monitor.
+
+    Every command succeeds, and each time notifications are (re)enabled for the
+    S850 status pin one ARMED-width pulse is reported on it, so a new callback
+    sees an edge through pigpio's own notification thread.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _PigpiodHandler)
+        self.lock = threading.Lock()
+        self.notify = {}  # handle -> notification socket
+        self.handles = itertools.count()
+        self.levels = 0xFFFFFFFF  # every input pulled up
+        self.tick = 0
+        self.seq = 0
+        self.pulses = 0
+        threading.Thread(target=self.serve_forever, name="soak-pigpiod", daemon=True).start()
+
+    def open_notify(self, sock):
+        with self.lock:
+            handle = next(self.handles)
+            self.notify[handle] = sock
+            return handle
+
+    def close_notify(self, handle):
+        with self.lock:
+            sock = self.notify.pop(handle, None)
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+
+    def watch(self, handle, bits):
+        bit = 1 << integration.S850_STATUS_PIN
+        with self.lock:
+            sock = self.notify.get(handle)
+            if sock is None or not bits & bit:
+                return
+            reports = b""
+            for level, width in ((self.levels & ~bit, 0), (self.levels, 60)):
+                self.tick = (self.tick + width + 1000) & 0xFFFFFFFF
+                self.seq = (self.seq + 1) & 0xFFFF
+                reports += struct.pack("HHII", self.seq, 0, self.tick, level)
+            self.pulses += 1
+            sock.sendall(reports)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+def install_services(directory, width=1280, height=720):
+    """Start the local services and point the integration's real clients at them; returns (services, base_url)."""
+    services = LocalServices(directory, width, height)
+    integration.SERVICE_ACCOUNT_FILE = services.service_account_file(directory)
+    # The stock build(), fetching its discovery documents from the local server
+    integration.build = functools.partial(integration.build,
+                                          discoveryServiceUrl=services.google_url + "discovery/{api}/{apiVersion}")
+    os.environ["REQUESTS_CA_BUNDLE"] = services.cert_file
+    # "rows" partitions, so the per-alarm read of column A stays one partition long over a million alarms
+    integration.ALARM_LOG_PARTITION = "rows"
+    integration.alarm_log = integration.new_alarm_log()
+    return services, services.camera_host
+
+
+def cycle_s850_monitor(pi, timeout_s=1.0):
+    """Start an S850Monitor callback, wait for its first pulse and cancel it, as a monitor restart does."""
+    monitor = integration.S850Monitor(lambda event: None, pi)
+    deadline = time.monotonic() + timeout_s
+    while monitor.current_state is None and time.monotonic() < deadline:
+        time.sleep(0.001)
+    monitor.callback.cancel()
+    return monitor.current_state is not None
+
+
+# ——— Resource sampling ——————————————————————————————————————————————
+try:
+    _malloc_trim = ctypes.CDLL("libc.so.6").malloc_trim
+except (OSError, AttributeError):
+    _malloc_trim = None  # not glibc
+
+
+def _rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def _open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+class Sample:
+    __slots__ = ("alarms", "elapsed", "rss_mb", "fds", "threads", "traced_mb", "snapshot")
+
+    def __init__(self, alarms, elapsed, snapshot):
+        gc.collect()
+        if _malloc_trim is not None:
+            # Hand freed arena memory back first: each Google client build parses megabytes of JSON,
+            # and without this RSS swings by tens of MB with whichever arenas happen to be empty
+            _malloc_trim(0)
+        self.alarms = alarms
+        self.elapsed = elapsed
+        self.rss_mb = _rss_mb()
+        self.fds = _open_fds()
+        self.threads = threading.active_count()
+        self.traced_mb = tracemalloc.get_traced_memory()[0] / 2**20 if tracemalloc.is_tracing() else 0.0
+        self.snapshot = tracemalloc.take_snapshot() if snapshot and tracemalloc.is_tracing() else None
+
+    def line(self):
+        return (f"{self.elapsed:8.0f} s {self.alarms:>10,} alarms  rss {self.rss_mb:7.1f} MB  "
+                f"fds {self.fds:4d}  threads {self.threads:3d}  traced {self.traced_mb:7.1f} MB")
+
+
+# ——— Soak run ———————————————————————————————————————————————————————
+def _simulated_events():
+    """Alarms as the three monitors would raise them."""
+    sources = [("gpio", cid, {"pin": pin}) for cid, pin in integration.HW_BUTTONS.items()]
+    sources += [("serial", cid, {"node_id": node}) for cid, node in integration.ALARM_NODE_MAP.items()]
+    sources.append(("s850", integration.S850_CONTACT_ID, None))
+    while True:
+        source, contact_id, payload = random.choice(sources)
+        yield AlarmEvent(contact_id, source, payload=payload)
+
+
+def soak(alarms, workers, sinks, base_url, pi, sample_every_s=SAMPLE_EVERY_S, trace=True):
+    contact_ids = list(integration.HW_BUTTONS) + list(integration.ALARM_NODE_MAP) + [integration.S850_CONTACT_ID]
+    # Odd Contact IDs are covered by two cameras, so the contact-sheet path is soaked too
+    alarm_table = {cid: AlarmStation(cid, ("Site", "Location", "Floor", "Zone", "Table", f"Unit {cid}"),
+                                     tuple(f"cam-{cid}{suffix}" for suffix in "ab"[:1 + int(cid) % 2]))
+                   for cid in contact_ids}
+    events = _simulated_events()
+    state = threading.Condition()
+    dispatched = itertools.count()
+    handled = [0]
+    busy = [0]
+    paused = [False]
+    s850_cycles = [0, 0]  # callbacks started and cancelled, pulses they saw
+
+    def worker():
+        while True:
+            with state:
+                state.wait_for(lambda: not paused[0])
+                if next(dispatched) >= alarms:
+                    return
+                event = next(events)
+                busy[0] += 1
+            seen = cycle_s850_monitor(pi) if event.source == "s850" else None
+            integration.handle_alarm(event, alarm_table, "soak-token", base_url, sinks)
+            with state:
+                handled[0] += 1
+                busy[0] -= 1
+                if seen is not None:
+                    s850_cycles[0] += 1
+                    s850_cycles[1] += seen
+                state.notify_all()
+
+    def quiescent_sample():
+        # The real clients hold megabytes mid-alarm, so the baseline is taken at rest, like the final sample
+        with state:
+            paused[0] = True
+            state.wait_for(lambda: busy[0] == 0)
+        sinks.drain()
+        sample = Sample(handled[0], time.monotonic() - start, snapshot=True)
+        with state:
+            paused[0] = False
+            state.notify_all()
+        return sample
+
+    if trace:
+        tracemalloc.start(25)
+    start = time.monotonic()
+    samples = [Sample(0, 0.0, snapshot=False)]
+    print(samples[0].line())
+    baseline = None
+    threads = [threading.Thread(target=worker, name=f"soak-{i}", daemon=True) for i in range(workers)]
+    for t in threads:
+        t.start()
+    next_sample = start + sample_every_s
+    while any(t.is_alive() for t in threads):
+        time.sleep(min(1.0, max(0.0, next_sample - time.monotonic())))
+        warmed_up = baseline is None and handled[0] >= alarms * WARMUP_FRACTION
+        if not warmed_up and time.monotonic() < next_sample:
+            continue
+        if warmed_up:
+            sample = baseline = quiescent_sample()
+        else:
+            sample = Sample(handled[0], time.monotonic() - start, snapshot=False)
+            next_sample += sample_every_s
+        samples.append(sample)
+        print(sample.line())
+    sinks.drain()
+    final = Sample(handled[0], time.monotonic() - start, snapshot=True)
+    samples.append(final)
+    return samples, baseline or samples[0], final, tuple(s850_cycles)
+
+
+def report(baseline, final, sinks, services, s850_cycles, max_rss_mb, max_fds, max_threads):
+    errors = health.source("alarm_handler").errors
+    rate = final.alarms / final.elapsed if final.elapsed else 0
+    print(f"\n{final.alarms:,} alarms in {final.elapsed:.0f} s ({rate:,.0f}/s), handler errors: {errors}")
+    rows = services.spreadsheet.logged_rows()
+    # Not a resource leak, so not a failure here, but a shortfall means concurrent handlers got the same row
+    print(f"  Alarm Log rows {rows:,} of {final.alarms:,}  "
+          f"S850 callbacks cycled {s850_cycles[0]:,}, saw their pulse {s850_cycles[1]:,}")
+    errors += s850_cycles[0] - s850_cycles[1]
+    for runner in sinks.runners:
+        print(f"  sink {runner.sink.name:10} written {runner.written:,}  dropped {runner.dropped}  errors {runner.errors}")
+        errors += runner.dropped + runner.errors
+    growth = {
+        "rss_mb": (final.rss_mb - baseline.rss_mb, max_rss_mb),
+        "fds": (final.fds - baseline.fds, max_fds),
+        "threads": (final.threads - baseline.threads, max_threads),
+    }
+    failed = errors > 0
+    for name, (delta, limit) in growth.items():
+        over = delta > limit
+        failed |= over
+        print(f"  {name:8} growth since warm-up: {delta:+.1f} (limit {limit}){'  FAIL' if over else ''}")
+    if baseline.snapshot and final.snapshot:
+        print(f"\nTop {TOP_ALLOCATORS} allocation growth since warm-up:")
+        for stat in final.snapshot.compare_to(baseline.snapshot, "lineno")[:TOP_ALLOCATORS]:
+            print(f"  {stat}")
+    if errors:
+        print(f"\nLast handler error: {health.source('alarm_handler').last_error}")
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run synthetic alarms through handle_alarm against local "
+                                                 "network services and watch for resource growth.")
+    parser.add_argument("--alarms", type=int, default=1_000_000,
+                        help="alarms to handle; the real Google clients take a few per second per worker")
+    parser.add_argument("--workers", type=int, default=3, help="concurrent sources, one per monitor thread by default")
+    parser.add_argument("--sample-every", type=float, default=SAMPLE_EVERY_S, metavar="SECONDS")
+    parser.add_argument("--max-rss-growth-mb", type=float, default=MAX_RSS_GROWTH_MB)
+    parser.add_argument("--max-fd-growth", type=int, default=MAX_FD_GROWTH)
+    parser.add_argument("--max-thread-growth", type=int, default=MAX_THREAD_GROWTH)
+    parser.add_argument("--no-tracemalloc", action="store_true", help="skip allocation tracking (faster, no top allocators)")
+    args = parser.parse_args()
+
+    setup_logging(level=logging.WARNING, fmt="text")
+    with tempfile.TemporaryDirectory() as tmp:
+        services, base_url = install_services(tmp)
+        pigpiod = Pigpiod()
+        pi = pigpio.pi("127.0.0.1", pigpiod.server_address[1])
+        # The local sinks, in a scratch directory; the Alarm Log itself is written by handle_alarm
+        sinks = SinkFanout([FileSink(os.path.join(tmp, "alarms.jsonl")), SnapshotStore(os.path.join(tmp, "snapshots"))])
+        try:
+            _, baseline, final, s850_cycles = soak(args.alarms, args.workers, sinks, base_url, pi,
+                                                   args.sample_every, trace=not args.no_tracemalloc)
+        finally:
+            sinks.close()
+            pi.stop()
+            pigpiod.close()
+            services.close()
+    ok = report(baseline, final, sinks, services, s850_cycles, args.max_rss_growth_mb, args.max_fd_growth,
+                args.max_thread_growth)
+    print("\nPASS" if ok else "\nFAIL")
+    raise SystemExit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,10 @@ from io import BytesIO
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseUpload
-from datetime import datetime
-import RPi.GPIO as GPIO
+import pigpio
 import time
+from Alarm_Core import AlarmEvent, parse_alarm_table
+from GPIO_Bank import GpioBank
 
 # Path to your service account key file
 SERVICE_ACCOUNT_FILE = "/home/roozdar/Desktop/projects/uplifted-record-443616-e6-63005fbd7104.json"  # Update with your Raspberry Pi file path
@@ -17,16 +18,12 @@ ALARM_LOG_SHEET_NAME = "Alarm Log"
 CREDENTIALS_SHEET_NAME = "Credentials"
 CREDENTIALS_RANGE = f"{CREDENTIALS_SHEET_NAME}!B1:B2"  # Range for JWT token and base URL
 ALARM_TABLE_RANGE = f"{CREDENTIALS_SHEET_NAME}!A5:G"  # Full range of the alarm table
+ALARM_TABLE_COLUMNS = 7  # Contact ID, Site, Location, Floor, Zone, Alarm Station, Camera ID
 
-# GPIO configuration
-GPIO.setmode(GPIO.BCM)  # Use BCM pin numbering
+# GPIO configuration (BCM pin numbering)
 BUTTON_PINS = [17, 27, 22, 23, 24]  # GPIO pins for buttons
 CONTACT_IDS = ["1", "2", "3", "4", "5"]  # Map buttons to Contact IDs
 
-# Set up GPIO pins as inputs with pull-up resistors
-for pin in BUTTON_PINS:
-    GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-
 # Authenticate and initialize the Sheets API
 def authenticate_sheets():
     print("Authenticating with Google Sheets API...")
@@ -61,7 +58,7 @@ def load_alarm_table():
         range=ALARM_TABLE_RANGE
     ).execute()
     rows = result.get('values', [])
-    alarm_table = {row[0]: row[1:] for row in rows if len(row) >= 7}  # Map Contact ID to remaining values
+    alarm_table = parse_alarm_table(rows, ALARM_TABLE_COLUMNS)  # Map Contact ID to its AlarmStation
     print(f"Loaded {len(alarm_table)} alarm stations.")
     return alarm_table
 
@@ -135,7 +132,7 @@ def get_next_available_row():
     return next_row
 
 # Append data to the Alarm Log sheet
-def append_row_to_sheet(data, image_buffer, image_height, device_id):
+def append_row_to_sheet(station, event, image_buffer, image_height):
     sheets = authenticate_sheets()
 
     # Get the next available row
@@ -147,7 +144,7 @@ def append_row_to_sheet(data, image_buffer, image_height, device_id):
 
     # Create the clickable URL
     # video_url = f"https://c028.eagleeyenetworks.com/live/index.html?id={device_id}&shortcut_override=false"
-    video_url = f"https://webapp.eagleeyenetworks.com/#/videoext/{device_id}"
+    video_url = f"https://webapp.eagleeyenetworks.com/#/videoext/{station.camera_id}"
 
     # Add row data and a clickable image
     requests = [
@@ -157,12 +154,8 @@ def append_row_to_sheet(data, image_buffer, image_height, device_id):
                 "rows": [
                     {
                         "values": [
-                            {"userEnteredValue": {"stringValue": str(data[0])}},  # Site
-                            {"userEnteredValue": {"stringValue": str(data[1])}},  # Location
-                            {"userEnteredValue": {"stringValue": str(data[2])}},  # Floor
-                            {"userEnteredValue": {"stringValue": str(data[3])}},  # Zone
-                            {"userEnteredValue": {"stringValue": str(data[4])}},  # Alarm Station
-                            {"userEnteredValue": {"stringValue": str(data[5])}},  # Timestamp
+                            # Site, Location, Floor, Zone, Alarm Station, Timestamp
+                            *({"userEnteredValue": {"stringValue": value}} for value in station.row_values(event)),
                             {
                                 "userEnteredValue": {
                                     "formulaValue": f'=HYPERLINK("{video_url}", IMAGE("{image_url}"))'
@@ -202,36 +195,38 @@ def main():
     alarm_table = load_alarm_table()
     jwt_token, base_url = read_credentials()
 
-    # Track which pins have already been ?handled? while LOW
-    handled = {cid: False for cid in CONTACT_IDS}
+    pi = pigpio.pi()
+    if not pi.connected:
+        print("pigpiod not running? Start with: sudo systemctl start pigpiod")
+        return
+
+    # Set up GPIO pins as inputs with pull-up resistors
+    contacts = dict(zip(CONTACT_IDS, BUTTON_PINS))
+    for pin in BUTTON_PINS:
+        pi.set_mode(pin, pigpio.INPUT)
+        pi.set_pull_up_down(pin, pigpio.PUD_UP)
+
+    # One read_bank_1() per pass; the bank remembers which contacts are already LOW,
+    # so each press triggers once and fires again only after it has gone HIGH
+    bank = GpioBank(contacts, pi.read_bank_1)
 
     print("Monitoring GPIO pins for alarms? Press Ctrl+C to stop.")
     try:
         while True:
-            for pin, contact_id in zip(BUTTON_PINS, CONTACT_IDS):
-                state = GPIO.input(pin)
-
-                # 1) LOW and never handled ? trigger once
-                if state == GPIO.LOW and not handled[contact_id]:
-                    handled[contact_id] = True
-                    print(f"Alarm on Contact ID {contact_id}")
-
-                    # your existing per-alarm logic:
-                    row_data = alarm_table.get(contact_id)
-                    if not row_data:
-                        print(f"No config for ID {contact_id}")
-                        continue
-
-                    device_id = row_data[-1]
-                    row_to_log = row_data[:-1] + [datetime.now().strftime("%Y-%m-%d %H:%M:%S")]
+            pressed, _released = bank.scan()
+            for contact_id in pressed:
+                print(f"Alarm on Contact ID {contact_id}")
 
-                    img_buf, img_h = fetch_and_resize_image(base_url, jwt_token, device_id)
-                    append_row_to_sheet(row_to_log, img_buf, img_h, device_id)
-                    print("Logged snapshot for Contact ID", contact_id)
+                # your existing per-alarm logic:
+                event = AlarmEvent(contact_id, "gpio", payload={"pin": contacts[contact_id]})
+                station = alarm_table.get(contact_id)
+                if not station:
+                    print(f"No config for ID {contact_id}")
+                    continue
 
-                # 2) HIGH and was handled ? reset so next LOW will fire again
-                elif state == GPIO.HIGH and handled[contact_id]:
-                    handled[contact_id] = False
+                img_buf, img_h = fetch_and_resize_image(base_url, jwt_token, station.camera_id)
+                append_row_to_sheet(station, event, img_buf, img_h)
+                print("Logged snapshot for Contact ID", contact_id)
 
             # short pause to debounce & avoid 100% CPU
             time.sleep(0.1)
@@ -241,7 +236,7 @@ def main():
     except Exception as e:
         print(f"Error: {e}")
     finally:
-        GPIO.cleanup()
+        pi.stop()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+import argparse
+import random
+import time
+
+
+class GpioBank:
+    """Scan active-low (pulled-up) contacts on GPIO 0-31 with one bank read per pass.
+
+    contacts maps Contact ID -> BCM pin; read_bank returns the 32-bit level mask,
+    normally pigpio's pi.read_bank_1. scan() diffs the new mask against the
+    previous one, so its cost depends on how many contacts changed, not on how
+    many are wired.
+    """
+
+    def __init__(self, contacts, read_bank):
+        self.read_bank = read_bank
+        self.mask = 0
+        self.by_pin = {}
+        for contact_id, pin in contacts.items():
+            if not 0 <= pin <= 31:
+                raise ValueError(f"GPIO {pin} for Contact ID {contact_id} is outside bank 1 (0-31).")
+            self.mask |= 1 << pin
+            self.by_pin[pin] = contact_id
+        # Start from "all released" so contacts already held LOW fire on the first scan
+        self.previous = self.mask
+
+    def scan(self):
+        """Return (newly LOW, newly HIGH) Contact IDs since the last scan."""
+        levels = self.read_bank() & self.mask
+        changed = levels ^ self.previous
+        if not changed:
+            return (), ()
+        self.previous = levels
+        return self._contacts(changed & ~levels), self._contacts(changed & levels)
+
+    def _contacts(self, bits):
+        contacts = []
+        while bits:
+            lowest = bits & -bits
+            contacts.append(self.by_pin[lowest.bit_length() - 1])
+            bits ^= lowest
+        return contacts
+
+
+# ——— Benchmark ——————————————————————————————————————————————————————
+def _simulated_banks(pins, scans, press_rate):
+    """Bank masks with all contacts HIGH and the odd contact pressed then released."""
+    all_high = sum(1 << pin for pin in pins)
+    banks = []
+    level = all_high
+    for _ in range(scans):
+        if random.random() < press_rate:
+            level ^= 1 << random.choice(pins)
+        banks.append(level)
+    return banks
+
+
+def _busy_wait(us):
+    if us:
+        end = time.perf_counter_ns() + int(us * 1000)
+        while time.perf_counter_ns() < end:
+            pass
+
+
+def bench(contacts=5, scans=100_000, press_rate=0.01, call_us=0.0):
+    pins = list(range(2, 2 + contacts))
+    banks = _simulated_banks(pins, scans, press_rate)
+    mapping = {str(i + 1): pin for i, pin in enumerate(pins)}
+    current = [0]
+
+    def read_bank():
+        _busy_wait(call_us)
+        return current[0]
+
+    def read_pin(pin):
+        _busy_wait(call_us)
+        return (current[0] >> pin) & 1
+
+    # Per-pin reads, as gpio_monitor did with GPIO.input()
+    handled = {cid: False for cid in mapping}
+    per_pin_events = 0
+    start = time.perf_counter()
+    for bank in banks:
+        current[0] = bank
+        for cid, pin in mapping.items():
+            state = read_pin(pin)
+            if state == 0 and not handled[cid]:
+                handled[cid] = True
+                per_pin_events += 1
+            elif state == 1 and handled[cid]:
+                handled[cid] = False
+    per_pin_s = time.perf_counter() - start
+
+    # One bank read and a bitmask diff per scan
+    gpio_bank = GpioBank(mapping, read_bank)
+    bank_events = 0
+    start = time.perf_counter()
+    for bank in banks:
+        current[0] = bank
+        pressed, _released = gpio_bank.scan()
+        bank_events += len(pressed)
+    bank_s = time.perf_counter() - start
+
+    assert per_pin_events == bank_events, (per_pin_events, bank_events)
+    return {
+        "contacts": contacts,
+        "scans": scans,
+        "presses": bank_events,
+        "per_pin_us": per_pin_s / scans * 1e6,
+        "bank_us": bank_s / scans * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-pin GPIO reads with a single bank snapshot on simulated banks.")
+    parser.add_argument("--contacts", type=int, nargs="+", default=[3, 5, 10, 20, 28])
+    parser.add_argument("--scans", type=int, default=100_000)
+    parser.add_argument("--press-rate", type=float, default=0.01, help="probability a contact toggles on a given scan")
+    parser.add_argument("--call-us", type=float, default=0.0,
+                        help="simulated cost of each hardware read call, e.g. a pigpiod socket round trip")
+    args = parser.parse_args()
+
+    print(f"{'contacts':>8} {'per-pin µs/scan':>16} {'bank µs/scan':>13} {'speedup':>8}")
+    for n in args.contacts:
+        r = bench(n, args.scans, args.press_rate, args.call_us)
+        print(f"{r['contacts']:>8} {r['per_pin_us']:>16.3f} {r['bank_us']:>13.3f} {r['per_pin_us'] / r['bank_us']:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
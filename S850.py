@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
+import argparse
 import pigpio
 import time
-import datetime
+import logging
+from Alarm_Logging import setup_logging
+
+log = logging.getLogger("s850")
 
 # ——— Configuration ——————————————————————————————————————————————————
 STATUS_PIN         = 17        # BCM pin number connected to the S850 status line
@@ -36,15 +40,30 @@ def edge_cb(gpio, level, tick):
 
         if new_state != current_state:
             current_state = new_state
-            ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            print(f"[{ts}] Stand state → {current_state} (pulse {width} µs)")
+            # Timestamping and formatting happen on the logging listener thread
+            log.info("Stand state → %s (pulse %d µs)", new_state, width, extra={"fields": {"state": new_state, "pulse_us": width}})
 
-def main():
+def check_timeout(now_tick):
+    """Return True (once) if no pulse has been seen for longer than ALARM_TIMEOUT_US."""
     global last_pulse_tick
+    if last_pulse_tick is not None and pigpio.tickDiff(last_pulse_tick, now_tick) > ALARM_TIMEOUT_US:
+        last_pulse_tick = None
+        return True
+    return False
+
+def reset_state():
+    global last_fall_tick, last_pulse_tick, current_state
+    last_fall_tick = last_pulse_tick = current_state = None
 
+def main():
+    parser = argparse.ArgumentParser(description="Monitor the S850 status line.")
+    parser.add_argument("--record", metavar="PATH", help="also record every edge to a replay capture file")
+    args = parser.parse_args()
+
+    setup_logging()
     pi = pigpio.pi()
     if not pi.connected:
-        print("❌ pigpiod not running? Start with: sudo systemctl start pigpiod")
+        log.error("❌ pigpiod not running? Start with: sudo systemctl start pigpiod")
         return
 
     # Configure input with pull-up
@@ -52,22 +71,31 @@ def main():
     pi.set_pull_up_down(STATUS_PIN, pigpio.PUD_UP)
 
     # Monitor both edges
-    pi.callback(STATUS_PIN, pigpio.EITHER_EDGE, edge_cb)
+    capture = None
+    callback = edge_cb
+    if args.record:
+        from Alarm_Replay import CaptureWriter
+        capture = CaptureWriter(args.record)
+
+        def callback(gpio, level, tick):
+            capture.edge(gpio, level, tick)
+            edge_cb(gpio, level, tick)
+    pi.callback(STATUS_PIN, pigpio.EITHER_EDGE, callback)
 
-    print(f"✅ Monitoring S850 status on GPIO{STATUS_PIN}. Ctrl-C to quit.")
+    log.info("✅ Monitoring S850 status on GPIO%d. Ctrl-C to quit.", STATUS_PIN)
 
     try:
         while True:
             time.sleep(1)
             # If no pulse for >1 s → ALARM
-            if last_pulse_tick is not None and pigpio.tickDiff(last_pulse_tick, pi.get_current_tick()) > ALARM_TIMEOUT_US:
-                ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                print(f"[{ts}] *** ALARM CONDITION: no pulses for >1 s ***")
-                last_pulse_tick = None
+            if check_timeout(pi.get_current_tick()):
+                log.warning("*** ALARM CONDITION: no pulses for >1 s ***")
     except KeyboardInterrupt:
-        print("\n🛑 Stopping monitor.")
+        log.info("🛑 Stopping monitor.")
     finally:
         pi.stop()
+        if capture:
+            capture.close()
 
 if __name__ == "__main__":
     main()